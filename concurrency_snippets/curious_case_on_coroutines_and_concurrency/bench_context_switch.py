@@ -0,0 +1,33 @@
+"""
+Micro-benchmark : how many context switches per second can the scheduler from `coroutine_os_01.py` do ?
+
+Each task is a coroutine that does nothing but `yield`. So all we measure is the cost of
+taking a task out of the ready queue, running it until the next yield and putting it back.
+We compare the thread-safe `queue.Queue` the scheduler used to have, with the plain deque based `ReadyQueue`.
+"""
+import time
+from queue import Queue
+
+from coroutine_os_01 import Scheduler, ReadyQueue
+
+NUM_TASKS = 100
+NUM_SWITCHES = 10_000 # per task
+
+def spin(n):
+    for _ in range(n):
+        yield
+
+def run(ready_queue_class):
+    sched = Scheduler()
+    sched.ready_queue = ready_queue_class()
+    for _ in range(NUM_TASKS):
+        sched.new(spin(NUM_SWITCHES))
+    start = time.perf_counter()
+    sched.mainloop()
+    return time.perf_counter() - start
+
+if __name__ == '__main__':
+    total = NUM_TASKS * (NUM_SWITCHES + 1)
+    for ready_queue_class in Queue, ReadyQueue:
+        elapsed = run(ready_queue_class)
+        print(f'{ready_queue_class.__name__:<12} {elapsed:.4f}s  {total / elapsed:,.0f} switches/sec')
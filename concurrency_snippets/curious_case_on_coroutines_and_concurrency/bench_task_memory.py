@@ -0,0 +1,85 @@
+"""
+Memory benchmark for tasks in `coroutine_os_03.py`.
+
+1. Bytes per live task : create lots of tasks and see how much memory tracemalloc says got allocated.
+   Compared with a Task that has a `__dict__` (how Task used to be, before __slots__).
+2. Spawn & reap : create and finish a million short lived tasks, a batch at a time.
+   Thanks to the freelist of Task objects, memory at the end should be about the same as after the first batch.
+"""
+import contextlib
+import os
+import tracemalloc
+
+import coroutine_os_03
+from coroutine_os_01 import NORMAL, Task
+from coroutine_os_03 import Scheduler
+
+NUM_LIVE = 100_000
+NUM_SPAWNED = 1_000_000
+BATCH_SIZE = 10_000
+
+class DictTask:
+    # Task as it was before __slots__ : same attributes, kept in a per-object __dict__.
+    # Not a subclass : a subclass inherits the slots, and its instances get BOTH slots and a __dict__.
+    def __init__(self, target, name=None, priority=NORMAL):
+        self.reset(target, name, priority)
+
+    def reset(self, target, name=None, priority=NORMAL):
+        Task.taskid += 1 # shared with Task, so tids stay unique
+        self.tid = Task.taskid
+        self.name = name
+        self.target = target
+        self.sendval = None
+        self.exception = None
+        self.priority = priority
+        self.vruntime = 0.0
+
+    def run(self):
+        if self.exception is not None:
+            exc, self.exception = self.exception, None
+            return self.target.throw(exc)
+        return self.target.send(self.sendval)
+
+def short_lived():
+    yield
+
+def bytes_per_live_task(task_class):
+    coroutine_os_03.Task = task_class
+    try:
+        sched = Scheduler()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for _ in range(NUM_LIVE):
+            sched.new(short_lived(), 'short_lived')
+        after = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        sched.close()
+    finally:
+        coroutine_os_03.Task = Task
+    return (after - before) / NUM_LIVE
+
+def spawn_and_reap():
+    # Same thing mainloop does when a task hits StopIteration, minus the rest of the loop.
+    sched = Scheduler()
+    tracemalloc.start()
+    first_batch = None
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(NUM_SPAWNED // BATCH_SIZE):
+            for _ in range(BATCH_SIZE):
+                sched.new(short_lived(), 'short_lived')
+            while sched.ready:
+                sched.exit(sched.ready.get())
+            if first_batch is None:
+                first_batch = tracemalloc.get_traced_memory()[0]
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    sched.close()
+    return first_batch, current, peak
+
+if __name__ == '__main__':
+    for task_class in DictTask, Task:
+        print(f'{task_class.__name__:<10} {bytes_per_live_task(task_class):.0f} bytes per live task (coroutine included)')
+
+    first_batch, current, peak = spawn_and_reap()
+    print(f'Spawned and reaped {NUM_SPAWNED:,} tasks : '
+          f'after first batch {first_batch / 1024:.0f} KiB, at the end {current / 1024:.0f} KiB, peak {peak / 1024:.0f} KiB')
@@ -9,24 +9,135 @@ Goal :
  - A task that runs until it hits yield. Then it transfers execution to another task.
 """
 
+# Scheduling classes. Lower number runs first.
+LATENCY = 0 # request handlers e.t.c. Should run as soon as they are ready.
+NORMAL = 1
+BATCH = 2   # background crunching. Runs only when nobody else is ready.
+
 class Task:
     """
     Create a Task class as a  Wrapper to run a coroutine.
     i.e rather than using coroutine object directly, use it through the `Task` interface
+
+    __slots__ : no per-object `__dict__`. Matters when there are a million tasks alive.
     """
+    __slots__ = ('tid', 'name', 'target', 'sendval', 'exception', 'priority', 'vruntime')
     taskid = 0
-    def __init__(self, target):
+    def __init__(self, target, name=None, priority=NORMAL):
+        self.reset(target, name, priority)
+
+    # Also used by the Scheduler to recycle a finished Task object for a new coroutine.
+    # The object is reused, the tid is not : a tid someone kept around must never point to another task.
+    def reset(self, target, name=None, priority=NORMAL):
         Task.taskid += 1
         self.tid = Task.taskid
+        self.name = name
         self.target = target # coroutine to be executed
         self.sendval = None
+        self.exception = None # if set, raised inside the coroutine instead of sending `sendval`
+        self.priority = priority
+        self.vruntime = 0.0 # total seconds spent inside `run`. Only tracked by the FairReadyQueue.
     # Run the task until it hits the next yield statement.
     def run(self):
+        if self.exception is not None:
+            exc, self.exception = self.exception, None
+            return self.target.throw(exc)
         return self.target.send(self.sendval)
 
+## Ready Queue
+from collections import deque
+import heapq
+
+class ReadyQueue(deque):
+    """
+    FIFO of tasks that are ready to run.
+
+    `queue.Queue` is made for threads : every put/get grabs a `threading.Condition` lock 
+    and notifies waiters. Our scheduler runs in a single thread, so all of that is pure overhead
+    paid on every context switch. A plain deque does the same job.
+    put/get are the deque's own (C implemented) methods, so there's no extra python call either.
+    Run `bench_context_switch.py` to see the difference.
+    """
+    put = deque.append
+    get = deque.popleft
+    # Scheduler times each `task.run()` only for queues that need it.
+    measures_runtime = False
+
+    def empty(self):
+        return not self
+
+class PriorityReadyQueue:
+    """
+    One FIFO per scheduling class. `get` always picks from the highest class that has a ready task.
+    So a LATENCY task that becomes ready runs at the very next yield, no matter how many 
+    BATCH tasks are queued in front of it.
+    NOTE : This is strict. A LATENCY task that never waits starves everything below it.
+    """
+    measures_runtime = False
+
+    def __init__(self, levels=BATCH + 1):
+        self.levels = [ReadyQueue() for _ in range(levels)]
+
+    def put(self, task):
+        self.levels[task.priority].append(task)
+
+    def get(self):
+        for level in self.levels:
+            if level:
+                return level.popleft()
+        raise IndexError('get from an empty ready queue')
+
+    def empty(self):
+        return not any(self.levels)
+
+    def __len__(self):
+        return sum(len(level) for level in self.levels)
+
+    def __iter__(self):
+        for level in self.levels:
+            yield from level
+
+class FairReadyQueue:
+    """
+    Linux CFS like. Between classes it's strict priority (like PriorityReadyQueue).
+    Inside a class, the task that has spent the least time running (`vruntime`) goes next. 
+    So a chatty coroutine that does a lot of work between two yields gets picked less often,
+    instead of getting the same turn as a task that yields right away.
+
+    A task coming back after a long wait (sleep, I/O ..) has a small vruntime. To stop it from 
+    hogging the CPU until it "catches up", it's vruntime is lifted to the smallest vruntime 
+    seen in it's class (min_vruntime).
+    """
+    measures_runtime = True
+
+    def __init__(self):
+        self.heap = []  # (priority, vruntime, seq, task)
+        self.seq = 0
+        self.min_vruntime = {}
+
+    def put(self, task):
+        floor = self.min_vruntime.get(task.priority, 0.0)
+        if task.vruntime < floor:
+            task.vruntime = floor
+        self.seq += 1
+        heapq.heappush(self.heap, (task.priority, task.vruntime, self.seq, task))
+
+    def get(self):
+        priority, vruntime, _, task = heapq.heappop(self.heap)
+        if vruntime > self.min_vruntime.get(priority, 0.0):
+            self.min_vruntime[priority] = vruntime
+        return task
+
+    def empty(self):
+        return not self.heap
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __iter__(self):
+        return (entry[-1] for entry in self.heap)
+
 ## Scheduler
-from queue import Queue
-from sched import scheduler
 
 class Scheduler:
     """
@@ -44,7 +155,7 @@ class Scheduler:
 
     """
     def __init__(self):
-        self.ready_queue = Queue()
+        self.ready_queue = ReadyQueue()
         self.taskmap = {}
 
     def new(self, target):
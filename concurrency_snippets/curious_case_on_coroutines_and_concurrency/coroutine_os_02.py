@@ -3,8 +3,7 @@ Continuing from `coroutine_os_01.py`, we add concept of coroutine/Application-pr
 Scheduler/OS. Take a look at `NewTask` System call. 
 """
 
-from coroutine_os_01 import Task
-from queue import Queue
+from coroutine_os_01 import Task, ReadyQueue
 
 class SystemCall(object):
     def handle(self):
@@ -19,7 +18,7 @@ class GetTid(SystemCall):
 
 class Scheduler:
     def __init__(self):
-        self.ready_queue = Queue()
+        self.ready_queue = ReadyQueue()
         self.taskmap = {}
 
     def new(self, target, name):
@@ -37,7 +36,7 @@ class Scheduler:
     def mainloop(self):
         while self.taskmap:
             # print('Queue State : ')
-            # for i in list(self.ready_queue.queue):
+            # for i in list(self.ready_queue):
             #     print(f'\t Task Details : ', (i.name, i.tid, id(i)))
             # print()
             task = self.ready_queue.get()
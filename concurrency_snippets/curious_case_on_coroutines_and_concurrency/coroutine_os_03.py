@@ -2,59 +2,299 @@
 # pyos6.py  -  The Python Operating System
 #
 # Added support for task waiting
+# Added support for sleeping (timer heap)
+# Added support for I/O waiting (selectors / epoll)
+# Added support for waiting on concurrent.futures
+# Added task groups and cancellation scopes
+# Added channels
 # ------------------------------------------------------------
 
 # ------------------------------------------------------------
 #                       === Tasks ===
 # ------------------------------------------------------------
-from coroutine_os_01 import Task
+from coroutine_os_01 import Task, ReadyQueue, NORMAL
 
 # ------------------------------------------------------------
 #                      === Scheduler ===
 # ------------------------------------------------------------
-from queue import Queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import os
+import selectors
+import time
 
 class Scheduler(object):
-    def __init__(self):
-        self.ready   = Queue()   
-        self.taskmap = {}        
+    def __init__(self, ready=None, executor=None, max_free=1024, trace=None, poll_every=64):
+        # Pass a PriorityReadyQueue / FairReadyQueue (coroutine_os_01.py) to use scheduling classes.
+        self.ready   = ready if ready is not None else ReadyQueue()
+        self.taskmap = {}
 
-        # Tasks waiting for other tasks to exit
+        # Sleepers and I/O are checked every `poll_every` context switches (see poll)
+        self.poll_every = poll_every
+
+        # Pass a SchedulerTrace (scheduler_trace.py) to record what the scheduler is doing.
+        # With None, all it costs is one `is not None` check per context switch.
+        self.trace = trace        
+
+        # Finished Task objects, kept around for reuse. Spawning and reaping lots of short lived tasks
+        # then doesn't keep allocating new ones. A reused Task gets a new tid (see Task.reset), so a stale
+        # tid in KillTask / WaitTask / TaskGroup.finished never refers to somebody else's task.
+        self.free = []
+        self.max_free = max_free
+
+        # Tasks waiting for other tasks to exit. Most tasks have one waiter at most, so we store the
+        # waiting task itself and only switch to a list once a second waiter shows up.
         self.exit_waiting = {}
 
-    def new(self,target, name):
-        newtask = Task(target,name)
+        # Task group (see TaskGroup) of every task that is a member of one
+        self.groups = {}
+
+        # Sleeping tasks. A min-heap of (deadline, seq, task), so the task that has to
+        # wake up first is always at sleeping[0]. `seq` breaks ties between equal deadlines
+        # (tasks themselves can't be compared).
+        self.sleeping = []
+        self.sleep_seq = 0
+
+        # Tasks waiting for a file (socket, pipe ..) to become readable / writable.
+        # DefaultSelector picks the best poller the OS has : epoll on Linux, kqueue on BSD/mac.
+        # Unlike `select.select` (see non_blocking_io/non_blocking_sock.py) it has no FD_SETSIZE limit,
+        # and the kernel only reports the files that are actually ready.
+        self.selector = selectors.DefaultSelector()
+        self.read_waiting = {}
+        self.write_waiting = {}
+        self.io_parked = {} # tid -> (read_waiting or write_waiting, fd). So a killed task can be unregistered.
+
+        # Tasks waiting for a concurrent.futures.Future (see generators_the_final_frontier/generators.py).
+        # A future finishes in some other thread, and it's callback must not touch the ready queue
+        # (it's not thread safe). So the callback only appends to `completed` (deque.append is thread safe)
+        # and writes a byte to the wakeup pipe. The read end sits in the selector, so a blocked iopoll wakes up.
+        self.completed = deque()
+        self.future_waiting = 0
+        self.wakeup_r, self.wakeup_w = os.pipe()
+        os.set_blocking(self.wakeup_r, False)
+        os.set_blocking(self.wakeup_w, False)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+
+        # Pool for RunInExecutor. Created on first use unless one is given.
+        self.executor = executor
+        self.own_executor = executor is None
+
+    def new(self,target, name, priority=NORMAL):
+        if self.free:
+            newtask = self.free.pop()
+            newtask.reset(target, name, priority)
+        else:
+            newtask = Task(target,name,priority)
         self.taskmap[newtask.tid] = newtask
         self.schedule(newtask)
         return newtask.tid
 
-    def exit(self,task):
+    def exit(self,task, killed=False):
         print(f"Task {task.tid} terminated ")
         del self.taskmap[task.tid]
+        if self.trace is not None:
+            self.trace.exit(task)
+        group = self.groups.pop(task.tid, None)
+        if group is not None:
+            group.member_exit(task.tid, killed)
         # Notify other tasks waiting for exit
-        for task in self.exit_waiting.pop(task.tid,[]):
-            self.schedule(task)
+        waiting = self.exit_waiting.pop(task.tid, None)
+        if type(waiting) is list:
+            for waiter in waiting:
+                self.schedule(waiter)
+        elif waiting is not None:
+            self.schedule(waiting)
+        # Let go of the finished coroutine right away, then keep the Task object for reuse.
+        # Not if it was killed though, stale references to it may still be around.
+        task.target = None
+        if not killed and len(self.free) < self.max_free:
+            self.free.append(task)
 
     def waitforexit(self,task,waittid):
         if waittid in self.taskmap:
-            self.exit_waiting.setdefault(waittid,[]).append(task)
+            waiting = self.exit_waiting.get(waittid)
+            if waiting is None:
+                self.exit_waiting[waittid] = task
+            elif type(waiting) is list:
+                waiting.append(task)
+            else:
+                self.exit_waiting[waittid] = [waiting, task]
             return True
         else:
             return False
 
+    def kill(self, tid):
+        """
+        Close the coroutine (GeneratorExit is raised at it's yield, so `finally` blocks run) 
+        and exit the task right away, so whoever waits for it wakes up now.
+        The task might still be referenced from the ready queue, the sleeping heap e.t.c. 
+        It's target is None from now on, which is how mainloop knows to skip it. 
+        """
+        task = self.taskmap.get(tid)
+        if task is None:
+            return False
+        parked = self.io_parked.pop(tid, None)
+        if parked is not None:
+            waiting, fd = parked
+            del waiting[fd]
+            self.update_fd(fd)
+        task.target.close()
+        self.exit(task, killed=True)
+        return True
+
     def schedule(self,task):
         self.ready.put(task)
 
+    def sleep(self, task, seconds):
+        # Park the task. It is NOT in the ready queue, so it costs nothing until it's deadline.
+        self.sleep_seq += 1
+        heapq.heappush(self.sleeping, (time.monotonic() + seconds, self.sleep_seq, task))
+
+    def wake_sleepers(self):
+        # Move every task whose deadline has passed back into the ready queue.
+        now = time.monotonic()
+        sleeping = self.sleeping
+        while sleeping and sleeping[0][0] <= now:
+            _, _, task = heapq.heappop(sleeping)
+            self.schedule(task)
+
+    # I/O waiting
+    def waitforread(self, task, fd):
+        self.read_waiting[fd] = task
+        self.io_parked[task.tid] = (self.read_waiting, fd)
+        self.update_fd(fd)
+
+    def waitforwrite(self, task, fd):
+        self.write_waiting[fd] = task
+        self.io_parked[task.tid] = (self.write_waiting, fd)
+        self.update_fd(fd)
+
+    def update_fd(self, fd):
+        # A file can have a reader and a writer parked on it at the same time.
+        # Tell the selector about whichever of them are still waiting.
+        events = 0
+        if fd in self.read_waiting:
+            events |= selectors.EVENT_READ
+        if fd in self.write_waiting:
+            events |= selectors.EVENT_WRITE
+        try:
+            if events:
+                self.selector.modify(fd, events)
+            else:
+                self.selector.unregister(fd)
+        except KeyError:
+            # Not registered yet
+            if events:
+                self.selector.register(fd, events)
+
+    # Future waiting
+    def waitforfuture(self, task, fut):
+        self.future_waiting += 1
+        def wakeup(fut):
+            # Runs in the thread that finished the future (or right here, if it's already done)
+            self.completed.append((task, fut))
+            try:
+                os.write(self.wakeup_w, b'\0')
+            except BlockingIOError:
+                pass # pipe is full, so a wakeup is pending anyway
+        fut.add_done_callback(wakeup)
+
+    def run_in_executor(self, task, fn, args):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor()
+        self.waitforfuture(task, self.executor.submit(fn, *args))
+
+    def wake_future_waiters(self):
+        try:
+            while os.read(self.wakeup_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        completed = self.completed
+        while completed:
+            task, fut = completed.popleft()
+            self.future_waiting -= 1
+            try:
+                task.sendval = fut.result()
+            except BaseException as exc:
+                # Raise it inside the task, at the `yield WaitFuture(..)`
+                task.exception = exc
+            self.schedule(task)
+
+    def iopoll(self, timeout):
+        if not self.read_waiting and not self.write_waiting and not self.future_waiting:
+            # Nothing to poll. Still honour the timeout so sleeping tasks don't make us spin.
+            if timeout:
+                time.sleep(timeout)
+            return
+        for key, events in self.selector.select(timeout):
+            fd = key.fileobj
+            if fd == self.wakeup_r:
+                self.wake_future_waiters()
+                continue
+            if events & selectors.EVENT_READ:
+                task = self.read_waiting.pop(fd)
+                del self.io_parked[task.tid]
+                self.schedule(task)
+            if events & selectors.EVENT_WRITE:
+                task = self.write_waiting.pop(fd)
+                del self.io_parked[task.tid]
+                self.schedule(task)
+            self.update_fd(fd)
+
+    def poll(self):
+        """
+        Sleep wakeups and I/O polling. Called by mainloop itself, NOT run as a task in the ready queue :
+        with a PriorityReadyQueue / FairReadyQueue, a poller task in any class can be starved by busy
+        tasks in higher classes, and then a LATENCY task parked in ReadWait never wakes up.
+        - While tasks are ready, poll with timeout 0 : just pick up whatever is ready and move on.
+        - When nobody is ready, there is nothing better to do than block in the kernel,
+          until some file is ready or the next sleeping task has to wake up.
+        """
+        if self.ready.empty():
+            timeout = None
+            if self.sleeping:
+                timeout = max(0.0, self.sleeping[0][0] - time.monotonic())
+            self.iopoll(timeout)
+        else:
+            self.iopoll(0)
+        if self.sleeping:
+            self.wake_sleepers()
+
     def mainloop(self):
+         # Poll every `poll_every` switches, or as soon as nothing is ready.
+         # Blocking in the kernel then never counts as some task's run time (vruntime).
+         trace = self.trace
+         timed = trace is not None or self.ready.measures_runtime
+         poll_every = self.poll_every
+         switches = 0
          while self.taskmap:
-            print('Queue State : ')
-            for i in list(self.ready.queue):
-                print(f'\t Task Details : ', (i.name, i.tid, id(i)))
-            print()
+            if switches >= poll_every or self.ready.empty():
+                self.poll()
+                switches = 0
+                if self.ready.empty():
+                    continue
+            switches += 1
             task = self.ready.get()
+            if task.target is None:
+                # Killed while it was waiting in the queue
+                continue
             try:
-                result = task.run()
+                if timed:
+                    start = time.perf_counter()
+                    try:
+                        result = task.run()
+                    finally:
+                        end = time.perf_counter()
+                        task.vruntime += end - start
+                        if trace is not None:
+                            trace.step(task, start, end, len(self.ready))
+                else:
+                    result = task.run()
                 if isinstance(result,SystemCall):
+                    if trace is not None:
+                        trace.syscall(task, result, end)
                     result.task  = task
                     result.sched = self
                     result.handle()
@@ -63,6 +303,183 @@ class Scheduler(object):
                 self.exit(task)
                 continue
             self.schedule(task)
+         self.close()
+
+    def close(self):
+        # The selector and the wakeup pipe are 3 file descriptors. mainloop calls this once all tasks are done,
+        # a Scheduler that never ran mainloop has to be closed by hand.
+        if self.executor is not None and self.own_executor:
+            self.executor.shutdown()
+            self.executor = None
+        if self.selector is not None:
+            self.selector.close()
+            self.selector = None
+            os.close(self.wakeup_r)
+            os.close(self.wakeup_w)
+
+# ------------------------------------------------------------
+#                    === Task Groups ===
+# ------------------------------------------------------------
+
+class TaskGroup(object):
+    """
+    Say a request handler fans out to 10 backends. Rather than keeping 10 tids around and
+    waiting for / killing each of them one by one :
+
+        group = TaskGroup(timeout=0.5)
+        for backend in backends:
+            yield NewTask(fetch(backend), 'fetch', group=group)
+        first = yield WaitGroup(group, 3)   # tids of the first 3 that finish
+        yield CancelGroup(group)            # don't need the rest
+
+    A group is also a cancellation scope :
+    - With a `timeout`, members still running at the deadline get killed. The deadline is enforced
+      by a small watchdog task that just Sleeps until then.
+    - A group first used from a task that is a member of another group becomes a child of that group.
+      It never outlives the parent's deadline, and cancelling the parent cancels it too.
+    Cancelling is O(members + child groups). Killed members get GeneratorExit, so `finally` blocks release resources.
+    """
+    def __init__(self, timeout=None):
+        self.deadline = time.monotonic() + timeout if timeout is not None else None
+        self.sched = None
+        self.tids = set()     # members still running
+        self.finished = []    # members that finished on their own (not killed), in order
+        self.children = []
+        self.waiting = []     # (task, n) blocked in WaitGroup
+        self.watchdog = None
+        self.cancelled = False
+
+    def bind(self, sched, creator):
+        # First spawn. The task doing it tells us which scope we are nested in.
+        self.sched = sched
+        parent = sched.groups.get(creator.tid)
+        if parent is not None:
+            parent.children.append(self)
+            if parent.deadline is not None and (self.deadline is None or parent.deadline < self.deadline):
+                self.deadline = parent.deadline
+            self.cancelled = self.cancelled or parent.cancelled
+
+    def spawn(self, sched, creator, target, name, priority):
+        if self.sched is None:
+            self.bind(sched, creator)
+        if self.cancelled:
+            target.close()
+            return None
+        tid = sched.new(target, name, priority)
+        self.tids.add(tid)
+        sched.groups[tid] = self
+        if self.deadline is not None and self.watchdog is None:
+            self.watchdog = sched.new(self.enforce_deadline(), 'watchdog')
+        return tid
+
+    def enforce_deadline(self):
+        yield Sleep(max(0.0, self.deadline - time.monotonic()))
+        self.watchdog = None
+        self.cancel()
+
+    def cancel(self):
+        self.cancelled = True
+        killed = 0
+        for child in self.children:
+            killed += child.cancel()
+        for tid in list(self.tids):
+            killed += self.sched.kill(tid)
+        if self.watchdog is not None:
+            self.sched.kill(self.watchdog)
+            self.watchdog = None
+        return killed
+
+    def done(self, n):
+        return not self.tids or (n is not None and len(self.finished) >= n)
+
+    def wait(self, task, n):
+        if self.done(n):
+            return self.finished[:n]
+        self.waiting.append((task, n))
+        return None
+
+    def member_exit(self, tid, killed):
+        self.tids.discard(tid)
+        if not killed:
+            self.finished.append(tid)
+        if self.waiting:
+            still_waiting = []
+            for task, n in self.waiting:
+                if self.done(n):
+                    task.sendval = self.finished[:n]
+                    self.sched.schedule(task)
+                else:
+                    still_waiting.append((task, n))
+            self.waiting = still_waiting
+        if not self.tids and self.watchdog is not None:
+            # Nothing left to guard. Don't keep the scheduler alive until the deadline.
+            self.sched.kill(self.watchdog)
+            self.watchdog = None
+
+# ------------------------------------------------------------
+#                      === Channels ===
+# ------------------------------------------------------------
+
+class Channel(object):
+    """
+    Coroutine version of the `Pipeline` in thread_safe_queue/producer_consumer.py. 
+    No threads and so no locks : only one task runs at a time, and it can't be interrupted between two yields.
+
+    A bounded buffer of `capacity` items :
+    - `yield Send(ch, item)` parks the sender while the buffer is full. That's the backpressure :
+      a fast producer can't get more than `capacity` items ahead of the consumer, so memory stays bounded.
+    - `item = yield Recv(ch)` parks the receiver while the buffer is empty.
+    - `items = yield RecvMany(ch, n)` gets whatever is there, up to n items, in one go. Parks only if there's nothing.
+    With capacity=0 nothing is buffered : the sender waits until a receiver takes the item.
+
+    Killed tasks may still be in `senders` / `receivers` (their target is None). They are skipped,
+    so an item is never handed to a dead receiver, and a dead sender's item is dropped.
+    """
+    def __init__(self, capacity=0):
+        self.capacity = capacity
+        self.buffer = deque()
+        self.senders = deque()   # (task, item) parked in Send
+        self.receivers = deque() # (task, n) parked in Recv (n is None) / RecvMany
+
+    def send(self, sched, task, item):
+        # Returns False if the sender has to wait
+        receivers = self.receivers
+        while receivers:
+            receiver, n = receivers.popleft()
+            if receiver.target is None:
+                continue
+            # If someone is waiting the buffer must be empty. Hand the item over directly.
+            receiver.sendval = item if n is None else [item]
+            sched.schedule(receiver)
+            return True
+        if len(self.buffer) < self.capacity:
+            self.buffer.append(item)
+            return True
+        self.senders.append((task, item))
+        return False
+
+    def recv(self, sched, task, n):
+        # Returns the list of received items, or None if the receiver has to wait
+        want = 1 if n is None else n
+        items = []
+        buffer = self.buffer
+        while buffer and len(items) < want:
+            items.append(buffer.popleft())
+        # We made room (or it's unbuffered). Let the parked senders go.
+        senders = self.senders
+        while senders and (len(items) < want or len(buffer) < self.capacity):
+            sender, item = senders.popleft()
+            if sender.target is None:
+                continue
+            if len(items) < want:
+                items.append(item) # buffer is empty here, so FIFO order is kept
+            else:
+                buffer.append(item)
+            sched.schedule(sender)
+        if items:
+            return items
+        self.receivers.append((task, n))
+        return None
 
 # ------------------------------------------------------------
 #                   === System Calls ===
@@ -87,12 +504,17 @@ class NewTask(SystemCall):
 
     We each task will be alternativly run in the main loop. 
     """
-    def __init__(self,target, name):
+    def __init__(self,target, name, priority=NORMAL, group=None):
         self.target = target
         self.name = name
+        self.priority = priority
+        self.group = group
     def handle(self):
         # OS schedules the new task
-        tid = self.sched.new(self.target, self.name)
+        if self.group is not None:
+            tid = self.group.spawn(self.sched, self.task, self.target, self.name, self.priority)
+        else:
+            tid = self.sched.new(self.target, self.name, self.priority)
         self.task.sendval = tid
         # But also schedule the current task
         self.sched.schedule(self.task)
@@ -102,12 +524,7 @@ class KillTask(SystemCall):
     def __init__(self,tid):
         self.tid = tid
     def handle(self):
-        task = self.sched.taskmap.get(self.tid,None)
-        if task:
-            task.target.close() 
-            self.task.sendval = True
-        else:
-            self.task.sendval = False
+        self.task.sendval = self.sched.kill(self.tid)
         self.sched.schedule(self.task)
 
 # Wait for a task to exit
@@ -131,6 +548,117 @@ class WaitTask(SystemCall):
         if not result:
             self.sched.schedule(self.task)
 
+# Sleep for a while
+class Sleep(SystemCall):
+    """
+    Unlike calling `time.sleep` inside a task (which blocks the whole scheduler, see `foo` in 
+    coroutine_os_01.py), this only parks the calling task. Other tasks keep running meanwhile.
+    The task is handed back to the ready queue once `seconds` have passed.
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+    def handle(self):
+        self.sched.sleep(self.task, self.seconds)
+
+# Wait for a file to be readable
+class ReadWait(SystemCall):
+    """
+    Yield this right before a call that would block (`sock.recv`, `sock.accept` ..).
+    Task is parked until the selector reports the file readable. `f` can be a socket, 
+    file object or a raw file descriptor.
+    """
+    def __init__(self, f):
+        self.f = f
+    def handle(self):
+        self.sched.waitforread(self.task, self.f)
+
+# Wait for a file to be writable
+class WriteWait(SystemCall):
+    def __init__(self, f):
+        self.f = f
+    def handle(self):
+        self.sched.waitforwrite(self.task, self.f)
+
+# Wait for a concurrent.futures.Future
+class WaitFuture(SystemCall):
+    """
+    `result = yield WaitFuture(fut)` parks the task until `fut` is done, then sends back `fut.result()`.
+    If the future failed, it's exception is raised at the yield.
+    Same thing `Task` in generators_the_final_frontier/generators.py does with add_done_callback,
+    except the other tasks keep running meanwhile.
+    """
+    def __init__(self, fut):
+        self.fut = fut
+    def handle(self):
+        self.sched.waitforfuture(self.task, self.fut)
+
+# Run a blocking function in a thread pool
+class RunInExecutor(SystemCall):
+    """
+    `result = yield RunInExecutor(fn, *args)`. For blocking calls we can't rewrite with ReadWait / WriteWait,
+    like a database driver. `fn` runs in the scheduler's ThreadPoolExecutor, off the loop.
+    """
+    def __init__(self, fn, *args):
+        self.fn = fn
+        self.args = args
+    def handle(self):
+        self.sched.run_in_executor(self.task, self.fn, self.args)
+
+# Wait for members of a TaskGroup
+class WaitGroup(SystemCall):
+    """
+    `finished = yield WaitGroup(group)` waits until no member is running anymore.
+    `finished = yield WaitGroup(group, n)` waits for the first n members to finish (or until none is left running).
+    Gets back the tids of members that finished on their own, in the order they finished.
+    """
+    def __init__(self, group, n=None):
+        self.group = group
+        self.n = n
+    def handle(self):
+        finished = self.group.wait(self.task, self.n)
+        if finished is not None:
+            self.task.sendval = finished
+            self.sched.schedule(self.task)
+
+# Send an item over a Channel
+class Send(SystemCall):
+    def __init__(self, channel, item):
+        self.channel = channel
+        self.item = item
+    def handle(self):
+        self.task.sendval = None
+        if self.channel.send(self.sched, self.task, self.item):
+            self.sched.schedule(self.task)
+
+# Receive one item from a Channel
+class Recv(SystemCall):
+    def __init__(self, channel):
+        self.channel = channel
+    def handle(self):
+        items = self.channel.recv(self.sched, self.task, None)
+        if items is not None:
+            self.task.sendval = items[0]
+            self.sched.schedule(self.task)
+
+# Receive up to n items from a Channel
+class RecvMany(SystemCall):
+    def __init__(self, channel, n):
+        self.channel = channel
+        self.n = n
+    def handle(self):
+        items = self.channel.recv(self.sched, self.task, self.n)
+        if items is not None:
+            self.task.sendval = items
+            self.sched.schedule(self.task)
+
+# Cancel a TaskGroup, and all groups nested in it
+class CancelGroup(SystemCall):
+    def __init__(self, group):
+        self.group = group
+    def handle(self):
+        self.task.sendval = self.group.cancel() # number of tasks killed
+        self.sched.schedule(self.task)
+
 # ------------------------------------------------------------
 #                      === Example ===
 # ------------------------------------------------------------
@@ -139,7 +667,7 @@ if __name__ == '__main__':
     def foo():
         for i in range(5):
             print("I'm foo")
-            yield
+            yield Sleep(0.1)
 
     def main():
         child = yield NewTask(foo(), "foo")
@@ -0,0 +1,333 @@
+"""
+Multi-core version of the coroutine OS from `coroutine_os_03.py`.
+
+A Scheduler lives in one process, so it can only ever use one core (same as threads, thanks to the GIL).
+To use all cores we start N worker processes and run a Scheduler in each of them. Tasks and SystemCalls
+work just like before. Some catches :
+
+- A coroutine (generator object) can't be pickled, i.e it can't be sent to another process.
+  What we send instead is a *task factory* : a module level function and it's arguments. The worker
+  calls `factory(*args)` to create the coroutine there.
+- Each task gets a global task id (gtid) that means the same thing in every process.
+  `NewTask`, `WaitTask` and `KillTask` below take / return gtids.
+- `NewTask` puts the factory in the inbox of the least loaded worker. A worker only pulls from it's inbox
+  while it runs less than `max_local` tasks. Whatever is left in an inbox can be stolen by a worker
+  that has nothing to do. (A coroutine that already started can't move, only pending factories can.)
+- Everything shared lives in `ClusterState` : multiprocessing Queues for the inboxes and shared memory
+  arrays for loads and task status. Workers look at it every `poll_interval` from a `housekeeper` task.
+"""
+import multiprocessing as mp
+import os
+import queue
+import time
+import traceback
+from multiprocessing.connection import wait
+
+from coroutine_os_01 import NORMAL
+from coroutine_os_03 import Scheduler, SystemCall, Sleep
+
+# Task states in ClusterState.status
+PENDING, RUNNING, DONE = 0, 1, 2
+
+class ClusterState:
+    """
+    Everything the workers share. Created in the parent and handed to every worker process.
+    Arrays are indexed by gtid.
+    """
+    def __init__(self, nworkers, max_tasks):
+        self.nworkers = nworkers
+        self.max_tasks = max_tasks
+        self.inboxes = [mp.Queue() for _ in range(nworkers)]   # pending task factories
+        self.controls = [mp.Queue() for _ in range(nworkers)]  # kill requests for running tasks
+        self.loads = mp.Array('i', nworkers)                   # pending + running tasks per worker
+        self.next_tid = mp.Value('i', 0)
+        self.outstanding = mp.Value('i', 0)                    # tasks created but not finished yet
+        self.status = mp.Array('b', max_tasks + 1, lock=False)
+        self.owner = mp.Array('i', max_tasks + 1, lock=False)  # worker index + 1. 0 means not started
+        self.killed = mp.Array('b', max_tasks + 1, lock=False)
+
+    def add_load(self, worker, n):
+        with self.loads.get_lock():
+            self.loads[worker] += n
+
+    def least_loaded(self):
+        loads = self.loads[:]
+        return loads.index(min(loads))
+
+    def submit(self, factory, args, name, priority, worker=None):
+        with self.next_tid.get_lock():
+            self.next_tid.value += 1
+            gtid = self.next_tid.value
+        if gtid > self.max_tasks:
+            raise RuntimeError(f'More than {self.max_tasks} tasks created. Increase max_tasks')
+        with self.outstanding.get_lock():
+            self.outstanding.value += 1
+        if worker is None:
+            worker = self.least_loaded()
+        self.add_load(worker, 1)
+        self.inboxes[worker].put((gtid, factory, args, name, priority))
+        return gtid
+
+    def exists(self, gtid):
+        return 0 < gtid <= self.next_tid.value and self.status[gtid] != DONE
+
+    def kill(self, gtid):
+        # A pending task looks at the flag right before it starts.
+        # For a running one, we also have to tell the worker that owns it.
+        self.killed[gtid] = 1
+        owner = self.owner[gtid]
+        if owner:
+            self.controls[owner - 1].put(gtid)
+
+
+class WorkerScheduler(Scheduler):
+    """
+    Scheduler of a single worker process. Knows which of it's local tasks map to which gtid.
+    """
+    def __init__(self, cluster, index, max_local=8, poll_interval=0.001, ready=None):
+        super().__init__(ready)
+        self.cluster = cluster
+        self.index = index
+        self.max_local = max_local
+        self.poll_interval = poll_interval
+        self.gtids = {}  # local tid -> gtid
+        self.local = {}  # gtid -> local tid
+
+        # Local tasks waiting for a task that runs in (or may get picked up by) another worker
+        self.remote_waiting = {}
+
+    def start(self, gtid, factory, args, name, priority):
+        cluster = self.cluster
+        cluster.owner[gtid] = self.index + 1
+        cluster.status[gtid] = RUNNING
+        if cluster.killed[gtid]:
+            # Killed before it ever ran
+            self.finish(gtid)
+            return
+        try:
+            coroutine = factory(*args)
+        except Exception:
+            print(f'Task {name} ({gtid}) failed to start in process {os.getpid()}')
+            traceback.print_exc()
+            self.finish(gtid)
+            return
+        tid = self.new(self.guard(coroutine, name, gtid), name, priority)
+        self.gtids[tid] = gtid
+        self.local[gtid] = tid
+
+    def guard(self, coroutine, name, gtid):
+        # A task that raises must not take the whole worker process down : it's gtid (and every other task
+        # of that worker) would never be DONE, `outstanding` would never get to 0 and the other workers
+        # would keep polling forever. It ends like any other task instead, so WaitTask on it returns.
+        try:
+            return (yield from coroutine)
+        except Exception:
+            print(f'Task {name} ({gtid}) failed in process {os.getpid()}')
+            traceback.print_exc()
+
+    def finish(self, gtid):
+        cluster = self.cluster
+        cluster.status[gtid] = DONE
+        cluster.add_load(self.index, -1)
+        with cluster.outstanding.get_lock():
+            cluster.outstanding.value -= 1
+
+    def exit(self, task, killed=False):
+        super().exit(task, killed)
+        gtid = self.gtids.pop(task.tid, None)
+        if gtid is not None:
+            del self.local[gtid]
+            self.finish(gtid)
+
+    def kill_local(self, gtid):
+        tid = self.local.get(gtid)
+        if tid is not None:
+            self.kill(tid)
+
+    def waitforgtid(self, task, gtid):
+        if gtid in self.local:
+            return self.waitforexit(task, self.local[gtid])
+        if not self.cluster.exists(gtid):
+            return False
+        self.remote_waiting.setdefault(gtid, []).append(task)
+        return True
+
+    # ---- Housekeeping. Runs every `poll_interval` ---- #
+    def housekeeper(self):
+        cluster = self.cluster
+        while cluster.outstanding.value:
+            self.drain_controls()
+            self.intake()
+            self.wake_remote_waiting()
+            yield Sleep(self.poll_interval)
+
+    def drain_controls(self):
+        control = self.cluster.controls[self.index]
+        while True:
+            try:
+                gtid = control.get_nowait()
+            except queue.Empty:
+                return
+            self.kill_local(gtid)
+
+    def intake(self):
+        inbox = self.cluster.inboxes[self.index]
+        while len(self.gtids) < self.max_local:
+            try:
+                job = inbox.get_nowait()
+            except queue.Empty:
+                break
+            self.start(*job)
+        if not self.gtids:
+            self.steal()
+
+    def steal(self):
+        # Nothing to do here. Take pending factories from the busiest peer.
+        cluster = self.cluster
+        if cluster.nworkers == 1:
+            return
+        loads = cluster.loads[:]
+        mine = loads[self.index]
+        loads[self.index] = -1
+        victim = loads.index(max(loads))
+        # Take half of the difference, so we don't just move the imbalance over here
+        count = min(self.max_local, max(1, (loads[victim] - mine) // 2))
+        for _ in range(count):
+            try:
+                job = cluster.inboxes[victim].get_nowait()
+            except queue.Empty:
+                return
+            cluster.add_load(victim, -1)
+            cluster.add_load(self.index, 1)
+            self.start(*job)
+
+    def wake_remote_waiting(self):
+        status = self.cluster.status
+        for gtid in [gtid for gtid in self.remote_waiting if status[gtid] == DONE]:
+            for task in self.remote_waiting.pop(gtid):
+                self.schedule(task)
+
+
+def worker_main(cluster, index, max_local, poll_interval):
+    sched = WorkerScheduler(cluster, index, max_local, poll_interval)
+    sched.new(sched.housekeeper(), 'housekeeper')
+    sched.mainloop()
+
+
+class Cluster:
+    """
+    Parent side. Spawn the first task(s) and call `run`, which returns once every task
+    (including the ones they created) is done.
+    """
+    def __init__(self, nworkers=None, max_tasks=1 << 16, max_local=8, poll_interval=0.001):
+        self.nworkers = nworkers or os.cpu_count()
+        self.max_local = max_local
+        self.poll_interval = poll_interval
+        self.state = ClusterState(self.nworkers, max_tasks)
+
+    def spawn(self, factory, *args, name=None, priority=NORMAL):
+        return self.state.submit(factory, args, name or factory.__name__, priority)
+
+    def run(self):
+        workers = [
+            mp.Process(target=worker_main, args=(self.state, i, self.max_local, self.poll_interval))
+            for i in range(self.nworkers)
+        ]
+        for worker in workers:
+            worker.start()
+        # Tasks can't crash a worker (see WorkerScheduler.guard), but a bug in the worker itself still could.
+        # Then it's tasks are never DONE, so stop the others rather than have them wait forever.
+        running = {worker.sentinel: worker for worker in workers}
+        crashed = None
+        while running:
+            for sentinel in wait(list(running)):
+                worker = running.pop(sentinel)
+                worker.join()
+                if worker.exitcode != 0 and crashed is None:
+                    crashed = worker
+                    with self.state.outstanding.get_lock():
+                        self.state.outstanding.value = 0
+                    for other in running.values():
+                        other.terminate()
+        if crashed is not None:
+            raise RuntimeError(f'Worker process died with exit code {crashed.exitcode}')
+
+# ------------------------------------------------------------
+#                   === System Calls ===
+# ------------------------------------------------------------
+
+# Create a new task, somewhere in the cluster
+class NewTask(SystemCall):
+    """
+    Same idea as NewTask in coroutine_os_03.py, but takes a factory instead of a coroutine.
+    Goes to the least loaded worker, or to our own worker if `local=True`.
+    Current task gets back the gtid of the new task.
+    """
+    def __init__(self, factory, *args, name=None, priority=NORMAL, local=False):
+        self.factory = factory
+        self.args = args
+        self.name = name or factory.__name__
+        self.priority = priority
+        self.local = local
+    def handle(self):
+        sched = self.sched
+        worker = sched.index if self.local else None
+        self.task.sendval = sched.cluster.submit(self.factory, self.args, self.name, self.priority, worker)
+        sched.schedule(self.task)
+
+# Kill a task, wherever it runs
+class KillTask(SystemCall):
+    def __init__(self, gtid):
+        self.gtid = gtid
+    def handle(self):
+        sched = self.sched
+        alive = sched.cluster.exists(self.gtid)
+        if alive:
+            if self.gtid in sched.local:
+                sched.kill_local(self.gtid)
+            else:
+                sched.cluster.kill(self.gtid)
+        self.task.sendval = alive
+        sched.schedule(self.task)
+
+# Wait for a task to exit, wherever it runs
+class WaitTask(SystemCall):
+    def __init__(self, gtid):
+        self.gtid = gtid
+    def handle(self):
+        result = self.sched.waitforgtid(self.task, self.gtid)
+        self.task.sendval = result
+        if not result:
+            self.sched.schedule(self.task)
+
+# ------------------------------------------------------------
+#                      === Example ===
+# ------------------------------------------------------------
+def fib(n):
+    if n <= 1 :
+        return n
+    else:
+        return fib(n-1) + fib(n-2)
+
+def fib_task(n, rounds):
+    # CPU heavy coroutine. Yields between rounds so other tasks in the same worker get a turn.
+    for _ in range(rounds):
+        fib(n)
+        yield
+    print(f'fib({n}) x {rounds} done in process {os.getpid()}')
+
+def parent(count):
+    children = []
+    for _ in range(count):
+        children.append((yield NewTask(fib_task, 24, 4)))
+    for gtid in children:
+        yield WaitTask(gtid)
+    print('All children done')
+
+if __name__ == '__main__':
+    for nworkers in sorted({1, os.cpu_count()}):
+        cluster = Cluster(nworkers)
+        cluster.spawn(parent, 16)
+        start = time.perf_counter()
+        cluster.run()
+        print(f'{nworkers} worker(s) : {time.perf_counter() - start:.4f}')
@@ -0,0 +1,174 @@
+"""
+Opt-in instrumentation for the Scheduler in `coroutine_os_03.py`.
+
+    trace = SchedulerTrace()
+    sched = Scheduler(trace=trace)
+    ...
+    sched.mainloop()
+    trace.print_summary()
+    trace.export_chrome('trace.json') # open in chrome://tracing or https://ui.perfetto.dev
+
+What gets recorded :
+- Every step (one `task.run()`, i.e from being resumed until the next yield) : which task, when, how long.
+- Number of switches and total run time per task.
+- Time spent waiting in a system call : from yielding it until running again. Totals per SystemCall type.
+- Ready queue depth after every step, as a histogram with power of 2 buckets.
+
+Steps and waits are kept in ring buffers (arrays allocated once, up front), so a long running scheduler
+doesn't keep growing memory. Only the last `capacity` of them are kept for the trace export. The totals cover everything.
+Per task counters only exist while the task is alive. When it exits (or is killed) they are folded into a
+table of the `top` busiest finished tasks, and it's name is kept among the last `capacity` names for the export.
+"""
+from array import array
+from collections import OrderedDict
+import heapq
+import json
+import os
+import time
+
+class Ring:
+    """Fixed size ring buffer of (tid, start, duration, kind) records."""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.count = 0
+        self.tid = array('l', [0]) * capacity
+        self.start = array('d', [0.0]) * capacity
+        self.duration = array('d', [0.0]) * capacity
+        self.kind = array('l', [0]) * capacity
+
+    def add(self, tid, start, duration, kind=0):
+        i = self.count % self.capacity
+        self.tid[i] = tid
+        self.start[i] = start
+        self.duration[i] = duration
+        self.kind[i] = kind
+        self.count += 1
+
+    def __iter__(self):
+        # Oldest first
+        for n in range(max(0, self.count - self.capacity), self.count):
+            i = n % self.capacity
+            yield self.tid[i], self.start[i], self.duration[i], self.kind[i]
+
+class SchedulerTrace:
+    def __init__(self, capacity=1 << 16, top=32):
+        self.epoch = time.perf_counter()
+        self.capacity = capacity
+        self.top = top
+        self.steps = Ring(capacity)  # kind : ready queue depth after the step
+        self.waits = Ring(capacity)  # kind : index in self.syscalls
+        self.names = {}              # tid -> task name, live tasks
+        self.switches = {}           # tid -> number of steps, live tasks
+        self.run_time = {}           # tid -> seconds spent running, live tasks
+        self.finished = []           # min-heap of (run time, tid, name, switches), the `top` busiest finished tasks
+        self.old_names = OrderedDict() # tid -> name, last `capacity` finished tasks
+        self.syscalls = []           # SystemCall type names, index is the `kind` in self.waits
+        self.syscall_index = {}
+        self.wait_time = {}          # SystemCall type name -> seconds waited
+        self.wait_count = {}
+        self.parked = {}             # tid -> (time it yielded a system call, index in self.syscalls)
+        self.depth_histogram = array('q', [0]) * 64 # bucket i counts depths with i bits
+
+    # ---- Called by Scheduler.mainloop ---- #
+    def step(self, task, start, end, depth):
+        tid = task.tid
+        self.steps.add(tid, start, end - start, depth)
+        self.switches[tid] = self.switches.get(tid, 0) + 1
+        self.run_time[tid] = self.run_time.get(tid, 0.0) + (end - start)
+        self.names[tid] = task.name
+        self.depth_histogram[depth.bit_length()] += 1
+        parked = self.parked.pop(tid, None)
+        if parked is not None:
+            parked_at, index = parked
+            self.waits.add(tid, parked_at, start - parked_at, index)
+            name = self.syscalls[index]
+            self.wait_time[name] += start - parked_at
+            self.wait_count[name] += 1
+
+    def syscall(self, task, syscall, now):
+        name = type(syscall).__name__
+        index = self.syscall_index.get(name)
+        if index is None:
+            index = self.syscall_index[name] = len(self.syscalls)
+            self.syscalls.append(name)
+            self.wait_time[name] = 0.0
+            self.wait_count[name] = 0
+        self.parked[task.tid] = (now, index)
+
+    def exit(self, task):
+        # Called by Scheduler.exit, for tasks that finished or were killed (maybe while parked)
+        tid = task.tid
+        self.parked.pop(tid, None)
+        name = self.names.pop(tid, task.name)
+        switches = self.switches.pop(tid, 0)
+        run_time = self.run_time.pop(tid, 0.0)
+        entry = (run_time, tid, name, switches)
+        if len(self.finished) < self.top:
+            heapq.heappush(self.finished, entry)
+        elif run_time > self.finished[0][0]:
+            heapq.heapreplace(self.finished, entry)
+        self.old_names[tid] = name
+        if len(self.old_names) > self.capacity:
+            self.old_names.popitem(last=False)
+
+    # ---- Reports ---- #
+    def print_summary(self, top=10):
+        print(f'Steps : {self.steps.count}')
+        print('Busiest tasks :')
+        tasks = self.finished + [(self.run_time[tid], tid, self.names[tid], self.switches[tid]) for tid in self.run_time]
+        for run_time, tid, name, switches in heapq.nlargest(top, tasks):
+            print(f'\t {name} ({tid}) : {switches} switches, {run_time * 1000:.3f} ms running')
+        print('Waiting in system calls :')
+        for name in self.syscalls:
+            count = self.wait_count[name]
+            if count:
+                print(f'\t {name} : {count} waits, {self.wait_time[name] / count * 1000:.3f} ms on average')
+        print('Ready queue depth :')
+        for bits, count in enumerate(self.depth_histogram):
+            if count:
+                low = 0 if bits == 0 else 1 << (bits - 1)
+                print(f'\t {low} - {(1 << bits) - 1} : {count}')
+
+    def export_chrome(self, path):
+        """Chrome trace-event format. Every task shows up as it's own row."""
+        pid = os.getpid()
+        def us(t):
+            return (t - self.epoch) * 1e6
+        # A row name for every task still in the rings
+        tids = {record[0] for record in self.steps} | {record[0] for record in self.waits}
+        events = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+             'args': {'name': f'{self.names.get(tid) or self.old_names.get(tid, "?")} ({tid})'}}
+            for tid in sorted(tids)
+        ]
+        for tid, start, duration, depth in self.steps:
+            events.append({'name': 'run', 'ph': 'X', 'pid': pid, 'tid': tid, 'ts': us(start), 'dur': duration * 1e6})
+            events.append({'name': 'ready queue', 'ph': 'C', 'pid': pid, 'ts': us(start + duration), 'args': {'depth': depth}})
+        for tid, start, duration, index in self.waits:
+            events.append({'name': self.syscalls[index], 'ph': 'X', 'cat': 'wait', 'pid': pid, 'tid': tid,
+                           'ts': us(start), 'dur': duration * 1e6})
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events}, f)
+
+if __name__ == '__main__':
+    from coroutine_os_03 import Scheduler, NewTask, WaitTask, Sleep
+
+    def worker(n):
+        for _ in range(n):
+            sum(range(10_000))
+            yield Sleep(0.001)
+
+    def main():
+        children = []
+        for n in range(1, 6):
+            children.append((yield NewTask(worker(n * 10), f'worker{n}')))
+        for tid in children:
+            yield WaitTask(tid)
+
+    trace = SchedulerTrace()
+    sched = Scheduler(trace=trace)
+    sched.new(main(), 'main')
+    sched.mainloop()
+    trace.print_summary()
+    trace.export_chrome('trace.json')
+    print('Trace written to trace.json')
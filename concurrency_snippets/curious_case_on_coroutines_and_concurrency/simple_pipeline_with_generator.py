@@ -1,35 +1,186 @@
 '''
 Emulating the unix pipeline : `tail -f log_file.txt | grep python`
-Collect the latest logs being written in a `log_file.txt` and show commands having `python` keyword only 
+Collect the latest logs being written in a `log_file.txt` and show commands having `python` keyword only
 
 Assuming another program (curently `writer_test.py`) is separately writing in the `log_file.txt` file.
+
+## ====== Waiting for new lines ====== ##
+The first version slept 5 seconds whenever readline() found nothing. So a new line showed up up to 5s late,
+and an idle file still woke us up every 5s.
+- inotify (Linux) : the kernel tells us when the file changed. We block in select() on the inotify fd and
+  wake up as soon as something is written, milliseconds instead of seconds. No syscalls at all while idle.
+  There's no inotify in the standard library, so it's called through ctypes.
+- Elsewhere (or if inotify fails), polling with exponential backoff : sleep 5ms, then 10ms, 20ms ..
+  up to `max_delay` (100ms, so a line is never later than that), and back to 5ms as soon as a line arrives.
+  Fast while the file is busy, cheap while idle.
+
+## ====== Rotation and truncation ====== ##
+logrotate either renames the file and a new one is created under the old name (rotation), or empties
+it in place (copytruncate). `tail -f` would keep reading the renamed file forever, or wait at an offset
+past the end of the emptied one. So whenever there's nothing new to read :
+- the inode behind the path changed (or it's gone) : finish reading the old file, then open the new one from the start.
+- the file is smaller than our position : it was truncated, read again from the start.
+We watch the directory, not the file, so inotify also tells us about the new file being created.
 '''
 
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
 import time
 
-def follow(log_file):
+# ---- inotify through ctypes ---- #
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+WATCH = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+EVENT = struct.Struct('iIII')  # struct inotify_event : wd, mask, cookie, len, then `len` bytes of name
+
+class Inotify:
+    """Waits for changes to one file (by name, in its directory). Raises OSError where there's no inotify."""
+    def __init__(self, path):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            init1, add_watch = libc.inotify_init1, libc.inotify_add_watch
+        except (OSError, AttributeError) as exc:
+            raise OSError(f'no inotify : {exc}') from None
+        # IN_NONBLOCK and IN_CLOEXEC have the same values as O_NONBLOCK and O_CLOEXEC
+        self.fd = init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1')
+        path = os.path.abspath(path)
+        self.name = os.fsencode(os.path.basename(path))
+        if add_watch(self.fd, os.fsencode(os.path.dirname(path)), WATCH) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, 'inotify_add_watch')
+
+    def wait(self, timeout=None):
+        """Until our file changed, or `timeout` seconds. Events for other files in the directory are skipped."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            if not select.select([self.fd], [], [], remaining)[0]:
+                return False
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                continue
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = EVENT.unpack_from(data, offset)
+                name = data[offset + EVENT.size:offset + EVENT.size + length].rstrip(b'\0')
+                offset += EVENT.size + length
+                if name == self.name or mask & IN_Q_OVERFLOW:
+                    return True
+
+    def reset(self):
+        pass
+
+    def close(self):
+        os.close(self.fd)
+
+class Backoff:
+    """The fallback : sleep, twice as long every time nothing new turned up."""
+    def __init__(self, min_delay=0.005, max_delay=0.1):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.delay = min_delay
 
-    log_file.seek(0, 2) ## More to the end of file. i.e position after the last character in the file
-    while True:
-        # this will read the last line. if there's a line, it moves the index to the end of line it reads. i.e the end of file again.
-        line = log_file.readline()
-        # if another program hasn't written anything yet, it will be empty string. So we wait for a while. 
-        if not line:
-            time.sleep(5)
-            continue
-        # finally return the line if present
-        yield line
+    def wait(self, timeout=None):
+        time.sleep(self.delay if timeout is None else min(self.delay, timeout))
+        self.delay = min(self.delay * 2, self.max_delay)
+        return True
+
+    def reset(self):
+        self.delay = self.min_delay
+
+    def close(self):
+        pass
+
+def watcher(path, max_delay=0.1):
+    try:
+        return Inotify(path)
+    except OSError:
+        return Backoff(max_delay=max_delay)
+
+# ---- The pipeline ---- #
+def follow(log_file, from_end=True, encoding='utf-8', max_delay=0.1, recheck=1.0):
+    '''
+    Yields lines appended to `log_file` (a path, or a file opened on one), across rotation and truncation.
+    `recheck` : even with inotify, look at the file at least this often (e.g. if the directory itself got replaced).
+    '''
+    # We open the path ourselves, in binary : tell() is then a plain byte offset, comparable to st_size
+    path = log_file if isinstance(log_file, (str, bytes, os.PathLike)) else log_file.name
+    changes = watcher(path, max_delay)
+    file = None
+    partial = b''  # a line the writer hasn't finished yet
+    try:
+        while True:
+            if file is None:
+                try:
+                    file = open(path, 'rb')
+                except FileNotFoundError:
+                    changes.wait(recheck)
+                    continue
+                if from_end:
+                    file.seek(0, 2) ## More to the end of file. i.e position after the last character in the file
+                from_end = False  # a file that shows up later (rotation) is read from the start
+                inode = os.fstat(file.fileno()).st_ino
+
+            # this will read the next line. if there's a line, it moves the index to the end of line it reads.
+            line = file.readline()
+            if line:
+                if not line.endswith(b'\n'):
+                    partial += line
+                    continue
+                changes.reset()
+                # finally return the line if present
+                yield (partial + line).decode(encoding, errors='replace')
+                partial = b''
+                continue
+
+            # Nothing new. Was the file rotated or truncated ?
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                stat = None
+            if stat is None or stat.st_ino != inode:
+                # Rotated. Everything in the old file has been read (readline came back empty), move to the new one.
+                file.close()
+                file = None
+                if partial:
+                    yield partial.decode(encoding, errors='replace')
+                    partial = b''
+                continue
+            if stat.st_size < file.tell():
+                file.seek(0)
+                partial = b''
+                continue
+            # if another program hasn't written anything yet, we wait until it does.
+            changes.wait(recheck)
+    finally:
+        changes.close()
+        if file is not None:
+            file.close()
 
 def grep(lines, pattern ):
     for line in lines:
         if pattern in line:
             yield line
 
-log_file = open('log_file.txt')
-
-## Creating a stack of generators. 
-log_lines = follow(log_file)
-python_lines = grep( log_lines , pattern='python')
+if __name__ == '__main__':
+    ## Creating a stack of generators.
+    log_lines = follow(sys.argv[1] if len(sys.argv) > 1 else 'log_file.txt')
+    python_lines = grep( log_lines , pattern='python')
 
-for line in python_lines:
-    print(line)
+    for line in python_lines:
+        print(line, end='')
@@ -0,0 +1,63 @@
+"""
+Writing 64 MiB, as 1 KiB chunks (like recv(1024) used to give us), in different ways :
+- open + write + close per chunk : what create_blocking used to do with file.txt
+- os.write per chunk             : file kept open, still one syscall per chunk
+- BufferedSink                   : one writev per MiB
+- BufferedSink, fsync 0.1s       : same, plus fdatasync at most every 0.1s
+- BufferedSink, O_DIRECT         : aligned writes around the page cache (if the filesystem has O_DIRECT)
+Best of 3. Written into a temporary directory here, not /tmp, which is often tmpfs (in memory, no O_DIRECT).
+"""
+import os
+import tempfile
+import time
+
+from buffered_sink import BufferedSink
+
+TOTAL = 64 * 2**20
+CHUNK = 1024
+CHUNKS = [os.urandom(CHUNK) for _ in range(64)]
+
+def chunks():
+    for i in range(TOTAL // CHUNK):
+        yield CHUNKS[i % len(CHUNKS)]
+
+def open_per_chunk(path):
+    for chunk in chunks():
+        with open(path, 'ab') as file:
+            file.write(chunk)
+    return TOTAL // CHUNK
+
+def write_per_chunk(path):
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    for chunk in chunks():
+        os.write(fd, chunk)
+    os.close(fd)
+    return TOTAL // CHUNK
+
+def sink(path, **options):
+    with BufferedSink(path, **options) as out:
+        for chunk in chunks():
+            out.write(chunk)
+    return out.syscalls
+
+def timed(fn, path, **options):
+    best = float('inf')
+    for _ in range(3):
+        if os.path.exists(path):
+            os.unlink(path)
+        start = time.perf_counter()
+        syscalls = fn(path, **options)
+        best = min(best, time.perf_counter() - start)
+        assert os.path.getsize(path) == TOTAL
+    return best, syscalls
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory(dir='.') as directory:
+        path = os.path.join(directory, 'out')
+        for name, fn, options in [('open + write + close per chunk', open_per_chunk, {}),
+                                  ('os.write per chunk', write_per_chunk, {}),
+                                  ('BufferedSink', sink, {}),
+                                  ('BufferedSink, fsync 0.1s', sink, {'fsync_interval': 0.1}),
+                                  ('BufferedSink, O_DIRECT', sink, {'direct': True})]:
+            elapsed, syscalls = timed(fn, path, **options)
+            print(f'{name:<32} {elapsed:.4f}s  {TOTAL / elapsed / 2**20:>8.0f} MiB/s  {syscalls:>6} write calls')
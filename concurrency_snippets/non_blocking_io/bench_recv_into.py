@@ -0,0 +1,52 @@
+"""
+recv(1024) + decode + `data += chunk` vs Receiver (recv_into, adaptive chunk, decode once).
+Both read the same response from `local_http_server.LocalServer` (in thread_safe_queue/), until the server closes the connection.
+Best of 3. NOTE : the server runs in this process too, so the times include it producing the body.
+"""
+import logging
+import os
+import socket
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'thread_safe_queue'))
+from local_http_server import LocalServer
+from non_blocking_sock import create_blocking
+
+SIZES = [1 * 2**20, 16 * 2**20, 64 * 2**20]
+
+def naive(host, port, path):
+    # What create_blocking used to do
+    s = socket.create_connection((host, port))
+    s.send(f"GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+    data = ""
+    while True:
+        chunk = s.recv(1024).decode(encoding='ISO-8859-1')
+        if not chunk:
+            break
+        data += chunk
+    s.close()
+    return data
+
+def timed(fn, *args, repeat=3, **kwargs):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.WARNING)
+    with LocalServer() as server:
+        host, port = server.address
+        for size in SIZES:
+            path = f'/close/{size}'
+            old = timed(naive, host, port, path)
+            new = timed(create_blocking, host, port, encoding='ISO-8859-1', path=path)
+            raw = timed(create_blocking, host, port, path=path)
+            unsized = timed(create_blocking, host, port, path=f'/eof/{size}')
+            with open(os.devnull, 'wb') as devnull:
+                streamed = timed(create_blocking, host, port, sink=devnull.fileno(), path=path)
+            print(f'{size // 2**20:>3} MiB : recv(1024) + += {old:.4f}s   recv_into {new:.4f}s   '
+                  f'recv_into, no decode {raw:.4f}s   no Content-Length {unsized:.4f}s   recv_into -> fd {streamed:.4f}s')
@@ -0,0 +1,160 @@
+"""
+Writing a download to disk as it arrives : one write() per chunk received. With 1 KiB chunks that's a
+syscall per KiB, and it was worse in `create_blocking` : an open() + write() + close() per chunk.
+For big downloads the time goes into syscalls, not into the network.
+
+BufferedSink keeps the file open and collects chunks until it has `buffer_size` bytes (or IOV_MAX chunks),
+then hands them all to the kernel in ONE `os.writev` call. Chunks are kept as they are, no joining :
+- bytes are immutable, so we just keep a reference. No copy.
+- anything else (bytearray, memoryview ..) is copied once, because the caller will reuse it for the next recv.
+
+Policies :
+- fsync_interval : seconds. After a flush, `os.fdatasync` if the last one is older than that. Without it,
+  data sits in the page cache and a power cut loses whatever the kernel hadn't written back yet.
+  fsync on every write is safe but slow, never is fast but unsafe. An interval bounds what can be lost.
+- direct : open with O_DIRECT, bypassing the page cache. A big download we won't read again only pushes
+  useful pages out of the cache. O_DIRECT wants the buffer address, file offset and length all aligned to the
+  block size, so chunks are copied into a page aligned mmap buffer and written in whole blocks. The unaligned
+  tail is written at close(), after turning O_DIRECT off. Filesystems without O_DIRECT (tmpfs ..) fall back to normal writes.
+
+    with BufferedSink('file.txt') as sink:
+        sink.write(chunk)
+"""
+import logging
+import mmap
+import os
+import time
+
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024
+BLOCK = 4096
+O_DIRECT = getattr(os, 'O_DIRECT', 0)
+
+
+class BufferedSink:
+    def __init__(self, target, buffer_size=1 << 20, append=False, fsync_interval=None, direct=False):
+        """`target` : a path, or a file descriptor we write to (and don't close)."""
+        self.buffer_size = buffer_size
+        self.fsync_interval = fsync_interval
+        self.last_sync = time.monotonic()
+        self.syscalls = 0  # write / writev calls, to compare with one write per chunk
+        self.written = 0
+        self.direct = bool(direct and O_DIRECT)
+
+        if isinstance(target, int):
+            self.fd = target
+            self.owned = False
+            self.direct = False
+        else:
+            flags = os.O_WRONLY | os.O_CREAT | (os.O_APPEND if append else os.O_TRUNC)
+            self.owned = True
+            if self.direct and append:
+                # Appending starts at an unaligned offset
+                self.direct = False
+            if self.direct:
+                try:
+                    self.fd = os.open(target, flags | O_DIRECT, 0o644)
+                except OSError:
+                    logging.info('%s : no O_DIRECT on this filesystem, using normal writes', target)
+                    self.direct = False
+            if not self.direct:
+                self.fd = os.open(target, flags, 0o644)
+
+        if self.direct:
+            # mmap memory is page aligned. buffer_size rounded up to whole blocks.
+            size = -(-buffer_size // BLOCK) * BLOCK
+            self.aligned = mmap.mmap(-1, size)
+            self.view = memoryview(self.aligned)
+            self.fill = 0
+        else:
+            self.iov = []
+            self.pending = 0
+
+    def fileno(self):
+        return self.fd
+
+    def write(self, data):
+        n = len(data)
+        if self.direct:
+            self.write_direct(data)
+            return n
+        if not n:
+            return 0
+        self.iov.append(data if isinstance(data, bytes) else bytes(data))
+        self.pending += n
+        if self.pending >= self.buffer_size or len(self.iov) >= IOV_MAX:
+            self.flush()
+        return n
+
+    def flush(self):
+        if self.direct:
+            # Only whole blocks can go out. The rest stays for the next flush, or close().
+            aligned = self.fill - self.fill % BLOCK
+            if aligned:
+                self.write_all(self.view[:aligned])
+                self.view[:self.fill - aligned] = self.view[aligned:self.fill]
+                self.fill -= aligned
+        else:
+            iov = self.iov
+            while iov:
+                sent = os.writev(self.fd, iov[:IOV_MAX])
+                self.syscalls += 1
+                self.written += sent
+                self.pending -= sent
+                # Partial writev : drop what went out, keep what's left of the first buffer that didn't
+                while sent:
+                    if len(iov[0]) <= sent:
+                        sent -= len(iov.pop(0))
+                    else:
+                        iov[0] = memoryview(iov[0])[sent:]
+                        sent = 0
+        self.maybe_sync()
+
+    def write_direct(self, data):
+        data = memoryview(data).cast('B')
+        while data:
+            take = min(len(data), len(self.aligned) - self.fill)
+            self.view[self.fill:self.fill + take] = data[:take]
+            self.fill += take
+            data = data[take:]
+            if self.fill == len(self.aligned):
+                self.flush()
+
+    def write_all(self, view):
+        while view:
+            sent = os.write(self.fd, view)
+            self.syscalls += 1
+            self.written += sent
+            view = view[sent:]
+
+    def maybe_sync(self, force=False):
+        if self.fsync_interval is None:
+            return
+        now = time.monotonic()
+        if force or now - self.last_sync >= self.fsync_interval:
+            os.fdatasync(self.fd)
+            self.last_sync = now
+
+    def close(self):
+        if self.fd is None:
+            return
+        self.flush()
+        if self.direct:
+            if self.fill:
+                # Unaligned tail : O_DIRECT off, then a normal write
+                import fcntl
+                flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+                fcntl.fcntl(self.fd, fcntl.F_SETFL, flags & ~O_DIRECT)
+                self.write_all(self.view[:self.fill])
+                self.fill = 0
+            self.view.release()
+            self.aligned.close()
+        self.maybe_sync(force=True)
+        if self.owned:
+            os.close(self.fd)
+        self.fd = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,429 @@
+"""
+Event driven HTTP/1.1 client. Many connections, one thread, no blocking calls (except DNS, see `address`).
+`create_non_blocking` in `non_blocking_sock.py` is the idea with one socket. This is it for thousands of requests.
+
+## ====== Why not select.select ====== ##
+select() takes the whole list of sockets on every call, the kernel scans all of them, and we scan the
+result again. O(n) per call, and it can't even look at a fd above FD_SETSIZE (1024).
+`selectors.DefaultSelector` is epoll on Linux (kqueue on BSD / macOS) : sockets are registered once,
+and each call only returns the ones that are ready.
+
+## ====== Connection state machine ====== ##
+    CONNECTING --(writable, SO_ERROR == 0)--> OPEN --(closed / error)--> CLOSED
+While OPEN :
+- Requests are written from `out` whenever the socket is writable. We only ask for EVENT_WRITE while
+  there is something in `out` (a socket is writable nearly all the time, asking always means a busy loop).
+- Whatever arrives is fed to a ResponseParser. Responses come back in the order requests were sent, so the n-th
+  parsed response belongs to the n-th request in `in_flight`.
+
+## ====== Pipelining ====== ##
+A connection doesn't wait for a response before sending the next request : up to `pipeline` requests are
+in flight on it. Saves a round trip per request. If the server closes the connection, requests that
+got no answer are put back in the host's queue (GET is safe to send again).
+An HTTP/1.0 server closes the connection after every response unless it says `Connection: keep-alive`,
+and isn't expected to pipeline at all. Once a host answers with HTTP/1.0, it gets one request per connection at a time.
+
+## ====== Incremental parsing ====== ##
+Data comes in whatever pieces the network feels like. The parser keeps what it has in a bytearray and
+goes as far as it can : status line + headers, then the body by Content-Length, chunked, or until the server closes.
+"""
+import errno
+import logging
+import os
+import selectors
+import socket
+import sys
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+# The test server is shared with the download snippets in thread_safe_queue/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'thread_safe_queue'))
+from local_http_server import LocalServer
+
+HEAD, BODY, CHUNK_SIZE, CHUNK_DATA, CHUNK_END, TRAILERS, UNTIL_CLOSE = range(7)
+CONNECTING, OPEN, CLOSED = range(3)
+
+
+class Response:
+    def __init__(self, status, reason, headers, body, version='HTTP/1.1'):
+        self.version = version
+        self.status = status
+        self.reason = reason
+        self.headers = headers  # lower cased names
+        self.body = body
+
+    @property
+    def keep_alive(self):
+        # HTTP/1.1 keeps the connection unless told otherwise, HTTP/1.0 closes it unless told otherwise
+        tokens = {token.strip() for token in self.headers.get('connection', '').lower().split(',')}
+        if self.version == 'HTTP/1.0':
+            return 'keep-alive' in tokens
+        return 'close' not in tokens
+
+
+class ResponseParser:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.state = HEAD
+        self.response = None
+        self.remaining = 0
+
+    def feed(self, data):
+        """Returns the responses completed by `data`. Usually none or one, more when pipelining."""
+        buffer = self.buffer
+        buffer += data
+        done = []
+        while True:
+            if self.state == HEAD:
+                end = buffer.find(b'\r\n\r\n')
+                if end < 0:
+                    break
+                lines = buffer[:end].decode('latin-1').split('\r\n')
+                del buffer[:end + 4]
+                version, status, reason = (lines[0].split(' ', 2) + [''])[:3]
+                headers = {}
+                for line in lines[1:]:
+                    name, _, value = line.partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                status = int(status)
+                if 100 <= status < 200:
+                    # 100 Continue and friends. The real response follows.
+                    continue
+                self.response = Response(status, reason, headers, bytearray(), version)
+                if status in (204, 304):
+                    done.append(self.finish())
+                elif headers.get('transfer-encoding', '').lower() == 'chunked':
+                    self.state = CHUNK_SIZE
+                elif 'content-length' in headers:
+                    self.remaining = int(headers['content-length'])
+                    self.state = BODY
+                    if not self.remaining:
+                        done.append(self.finish())
+                else:
+                    self.state = UNTIL_CLOSE
+            elif self.state in (BODY, CHUNK_DATA):
+                take = min(self.remaining, len(buffer))
+                if not take:
+                    break
+                self.response.body += buffer[:take]
+                del buffer[:take]
+                self.remaining -= take
+                if self.remaining:
+                    break
+                if self.state == BODY:
+                    done.append(self.finish())
+                else:
+                    self.state = CHUNK_END
+            elif self.state == CHUNK_SIZE:
+                end = buffer.find(b'\r\n')
+                if end < 0:
+                    break
+                size = int(buffer[:end].split(b';', 1)[0], 16)
+                del buffer[:end + 2]
+                self.remaining = size
+                self.state = CHUNK_DATA if size else TRAILERS
+            elif self.state == CHUNK_END:
+                if len(buffer) < 2:
+                    break
+                del buffer[:2]
+                self.state = CHUNK_SIZE
+            elif self.state == TRAILERS:
+                end = buffer.find(b'\r\n')
+                if end < 0:
+                    break
+                del buffer[:end + 2]
+                if end == 0:
+                    done.append(self.finish())
+            else:  # UNTIL_CLOSE
+                self.response.body += buffer
+                buffer.clear()
+                break
+        return done
+
+    def eof(self):
+        """Server closed the connection. Returns the response that ends with it, if any."""
+        if self.state == UNTIL_CLOSE:
+            return self.finish()
+        return None
+
+    def finish(self):
+        response, self.response = self.response, None
+        response.body = bytes(response.body)
+        self.state = HEAD
+        return response
+
+
+class Request:
+    def __init__(self, url, callback=None):
+        self.url = url
+        parts = urlsplit(url)
+        if parts.scheme != 'http':
+            raise ValueError(f'Only http:// urls : {url}')
+        self.key = (parts.hostname, parts.port or 80)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+        self.data = f'GET {target} HTTP/1.1\r\nHost: {parts.netloc}\r\n\r\n'.encode('latin-1')
+        self.callback = callback
+        self.attempts = 0
+        self.response = None
+        self.error = None
+
+    def done(self, response=None, error=None):
+        self.response = response
+        self.error = error
+        if self.callback is not None:
+            self.callback(self)
+
+
+class Host:
+    def __init__(self):
+        self.queue = deque()      # requests not sent yet
+        self.connections = []
+        self.connect_failures = 0 # in a row
+        self.http10 = False       # answered with HTTP/1.0 : no pipelining to it
+
+
+class Connection:
+    def __init__(self, engine, key, address):
+        self.engine = engine
+        self.key = key
+        self.sock = socket.socket(address[0], socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.state = CONNECTING
+        self.out = bytearray()
+        self.in_flight = deque()  # sent (or being sent), waiting for their response
+        self.parser = ResponseParser()
+        self.served = 0
+        self.last_active = time.monotonic()
+        err = self.sock.connect_ex(address[4])
+        if err not in (0, errno.EINPROGRESS):
+            self.sock.close()
+            raise OSError(err, f'connect to {key} : {errno.errorcode.get(err, err)}')
+        self.events = selectors.EVENT_WRITE
+        engine.selector.register(self.sock, self.events, self)
+
+    def send(self, request):
+        request.attempts += 1
+        self.in_flight.append(request)
+        self.out += request.data
+        self.update()
+
+    def update(self):
+        events = selectors.EVENT_READ
+        if self.state == CONNECTING or self.out:
+            events |= selectors.EVENT_WRITE
+        if events != self.events:
+            self.events = events
+            self.engine.selector.modify(self.sock, events, self)
+
+    def on_writable(self):
+        if self.state == CONNECTING:
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                self.close(OSError(err, f'connect to {self.key} : {errno.errorcode.get(err, err)}'))
+                return
+            self.state = OPEN
+            self.engine.hosts[self.key].connect_failures = 0
+            self.engine.pump(self.key)
+        if self.out:
+            try:
+                sent = self.sock.send(self.out)
+            except BlockingIOError:
+                return
+            except OSError as exc:
+                self.close(exc)
+                return
+            del self.out[:sent]
+            self.last_active = time.monotonic()
+        self.update()
+
+    def on_readable(self):
+        try:
+            data = self.sock.recv(self.engine.recv_size)
+        except BlockingIOError:
+            return
+        except OSError as exc:
+            self.close(exc)
+            return
+        self.last_active = time.monotonic()
+        if not data:
+            response = self.parser.eof()
+            if response is not None and self.in_flight:
+                # A body that ends when the server closes. The close was expected, so like below, requests
+                # pipelined behind it don't count as a failed attempt.
+                self.in_flight.popleft().done(response)
+                for request in self.in_flight:
+                    request.attempts -= 1
+            self.close(ConnectionError(f'{self.key} closed the connection'))
+            return
+        for response in self.parser.feed(data):
+            if response.version == 'HTTP/1.0':
+                # Even with keep-alive, a 1.0 server isn't required to handle pipelined requests
+                self.engine.hosts[self.key].http10 = True
+            self.served += 1
+            self.in_flight.popleft().done(response)
+            if not response.keep_alive:
+                # Server said so itself. Requests pipelined behind this one never got a chance, they
+                # go back to the queue without counting as a failed attempt.
+                for request in self.in_flight:
+                    request.attempts -= 1
+                self.close(ConnectionError(f'{self.key} closed the connection'))
+                return
+        self.engine.pump(self.key)
+
+    def close(self, error):
+        if self.state == CLOSED:
+            return
+        connecting = self.state == CONNECTING
+        self.state = CLOSED
+        self.engine.selector.unregister(self.sock)
+        self.sock.close()
+        self.engine.closed(self, error, connecting)
+
+
+class HTTPClientEngine:
+    """
+    engine = HTTPClientEngine()
+    requests = [engine.get(url) for url in urls]
+    engine.run()
+    requests[0].response.body ...
+
+    max_per_host : connections opened to the same host and port, at most.
+    pipeline : requests in flight on one connection. 1 means plain keep-alive, no pipelining.
+    timeout : seconds without data on a connection with requests in flight.
+    connect_timeout : seconds a connection may stay CONNECTING (default : timeout). Without it, a host that
+        drops our SYNs keeps us waiting for the kernel to give up, about 2 minutes per attempt.
+    """
+    def __init__(self, max_per_host=64, pipeline=8, timeout=30.0, retries=2, recv_size=256 * 1024, connect_timeout=None):
+        self.selector = selectors.DefaultSelector()
+        self.max_per_host = max_per_host
+        self.pipeline = pipeline
+        self.timeout = timeout
+        self.connect_timeout = timeout if connect_timeout is None else connect_timeout
+        self.retries = retries
+        self.recv_size = recv_size
+        self.hosts = {}
+        self.addresses = {}
+        self.pending = 0  # requests not done yet
+
+    def get(self, url, callback=None):
+        request = Request(url, callback)
+        self.pending += 1
+        user_callback = request.callback
+
+        def finished(request):
+            self.pending -= 1
+            if user_callback is not None:
+                user_callback(request)
+        request.callback = finished
+        self.hosts.setdefault(request.key, Host()).queue.append(request)
+        return request
+
+    def address(self, key):
+        # getaddrinfo blocks. Once per host is good enough here, an async resolver would be the next step.
+        if key not in self.addresses:
+            self.addresses[key] = socket.getaddrinfo(*key, type=socket.SOCK_STREAM)[0]
+        return self.addresses[key]
+
+    def pump(self, key):
+        """Hand queued requests of a host to it's connections. Open more connections if needed."""
+        host = self.hosts[key]
+        queue = host.queue
+        pipeline = 1 if host.http10 else self.pipeline
+        for conn in host.connections:
+            if not queue:
+                return
+            if conn.state != OPEN:
+                continue
+            while queue and len(conn.in_flight) < pipeline:
+                conn.send(queue.popleft())
+        # Connections that are still connecting will take `pipeline` requests each once they're up
+        connecting = sum(conn.state == CONNECTING for conn in host.connections)
+        while len(queue) > connecting * pipeline and len(host.connections) < self.max_per_host:
+            try:
+                host.connections.append(Connection(self, key, self.address(key)))
+            except OSError as exc:
+                if not host.connections:
+                    self.fail_all(key, exc)
+                return
+            connecting += 1
+
+    def closed(self, conn, error, connecting):
+        host = self.hosts[conn.key]
+        host.connections.remove(conn)
+        # Whatever got no answer goes back to the front of the queue, in order
+        while conn.in_flight:
+            request = conn.in_flight.pop()
+            if request.attempts > self.retries:
+                request.done(error=error)
+            else:
+                host.queue.appendleft(request)
+        if connecting:
+            host.connect_failures += 1
+            if host.connect_failures > self.retries and not any(other.state == OPEN for other in host.connections):
+                # Host is down (or doesn't exist). Don't keep trying forever.
+                self.fail_all(conn.key, error)
+                return
+        self.pump(conn.key)
+
+    def fail_all(self, key, error):
+        queue = self.hosts[key].queue
+        while queue:
+            queue.popleft().done(error=error)
+
+    def run(self):
+        for key in self.hosts:
+            self.pump(key)
+        while self.pending:
+            for key, events in self.selector.select(timeout=1.0):
+                conn = key.data
+                if events & selectors.EVENT_WRITE:
+                    conn.on_writable()
+                if events & selectors.EVENT_READ and conn.state != CLOSED:
+                    conn.on_readable()
+            self.expire()
+
+    def expire(self):
+        now = time.monotonic()
+        for host in self.hosts.values():
+            for conn in list(host.connections):
+                if conn.state == CONNECTING and now - conn.last_active > self.connect_timeout:
+                    # Counts as a failed connect, see `closed`
+                    conn.close(TimeoutError(f'connect to {conn.key} : no answer after {self.connect_timeout}s'))
+                elif conn.in_flight and now - conn.last_active > self.timeout:
+                    # Timed out requests are not sent again
+                    for request in conn.in_flight:
+                        request.attempts = self.retries + 1
+                    conn.close(TimeoutError(f'{conn.key} : no data for {self.timeout}s'))
+
+    def close(self):
+        for host in self.hosts.values():
+            for conn in list(host.connections):
+                conn.close(ConnectionError('engine closed'))
+        self.selector.close()
+
+
+# ---- Pipelining vs plain keep-alive, on the local server ---- #
+NUM_REQUESTS = 5000
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(levelname)s - %(asctime)s: %(message)s', datefmt='%H:%M:%S', level=logging.INFO)
+    with LocalServer() as server:
+        urls = [f'{server.url}/{kind}/{size}' for kind, size in [('bytes', 1024), ('chunked', 4096), ('bytes', 100)] * (NUM_REQUESTS // 3)]
+        urls += [f'{server.url}/close/10'] * 10
+        for pipeline in 1, 8:
+            before = server.connections
+            engine = HTTPClientEngine(max_per_host=32, pipeline=pipeline)
+            requests = [engine.get(url) for url in urls]
+            start = time.perf_counter()
+            engine.run()
+            elapsed = time.perf_counter() - start
+            engine.close()
+            failed = sum(request.error is not None for request in requests)
+            received = sum(len(request.response.body) for request in requests if request.response)
+            logging.info('pipeline %d : %d requests in %.4fs (%d req/sec), %d failed, %.1f MiB, %d connections',
+                         pipeline, len(requests), elapsed, len(requests) / elapsed, failed, received / 2**20,
+                         server.connections - before)
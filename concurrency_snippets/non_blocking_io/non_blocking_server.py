@@ -0,0 +1,301 @@
+"""
+The server side of `non_blocking_sock.py`. One thread, many connections, nothing blocks.
+Same loop as `create_non_blocking` : wait until some sockets are readable / writable, serve those, repeat.
+With `selectors` (epoll) instead of select.select, for the reasons in `http_client_engine.py`.
+
+It speaks just enough HTTP/1.1 to be load tested : every request (headers only, no body) gets a response,
+in order, keep-alive. `GET /bytes/{n}` answers n bytes, anything else "hello".
+
+## ====== Accept batching ====== ##
+When the listening socket is readable, there may be many connections waiting in the backlog. We accept
+up to `accept_batch` of them in one go (until BlockingIOError), instead of one per trip around the loop.
+Out of file descriptors (EMFILE / ENFILE), accept fails but the listening socket stays readable, so asking
+again right away is a busy loop. We stop watching it for `accept_pause` seconds (or until a connection closes)
+and keep serving the connections we have. The waiting connections stay in the backlog meanwhile.
+
+## ====== Write queues and sendmsg ====== ##
+send() may take only part of what we give it (the socket buffer is full). Whatever is left waits in the
+connection's `out` queue, and goes out when the socket is writable again.
+Responses are queued as they are (headers and body as separate buffers, never joined) and flushed with
+`sendmsg` : one syscall hands the kernel a list of buffers (scatter-gather, like writev).
+
+## ====== Backpressure ====== ##
+A client that sends requests faster than it reads responses makes `out` grow without limit. Once it holds
+more than `high_water` bytes we stop answering (the rest of the requests stay in `inbuf`) and stop reading
+from that connection (no EVENT_READ). The client's requests wait in the kernel, and TCP flow control
+eventually slows the client down. Answering and reading resume below `low_water`.
+
+## ====== One process per core ====== ##
+Python runs one thread at a time, so one event loop is one core. With SO_REUSEPORT, several processes
+can each bind their own listening socket to the same port, and the kernel spreads new connections between them.
+"""
+import errno
+import logging
+import multiprocessing as mp
+import os
+import re
+import selectors
+import socket
+import time
+from collections import deque
+from itertools import islice
+
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024
+
+HELLO = b'hello'
+
+
+def listener(host, port, backlog=1024, reuse_port=True):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+class Connection:
+    def __init__(self, sock):
+        self.sock = sock
+        self.inbuf = bytearray()
+        self.out = deque()  # memoryviews waiting to be sent
+        self.out_bytes = 0
+        self.paused = False # not reading
+        self.held = False   # complete requests left in inbuf because of the high water mark
+        self.events = selectors.EVENT_READ
+
+
+class Server:
+    def __init__(self, host='127.0.0.1', port=0, accept_batch=64, high_water=1 << 20, low_water=256 << 10,
+                 reuse_port=True, recv_size=64 * 1024, accept_pause=0.1):
+        self.sock = listener(host, port, reuse_port=reuse_port)
+        self.address = self.sock.getsockname()
+        self.accept_batch = accept_batch
+        self.accept_pause = accept_pause
+        self.accept_paused_until = None
+        self.high_water = high_water
+        self.low_water = low_water
+        self.recv_size = recv_size
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.sock, selectors.EVENT_READ, None)
+        self.open = set()  # includes connections not in the selector (no events wanted right now)
+        self.connections = 0
+        self.requests = 0
+
+    def serve_forever(self, stop=None, poll_interval=0.5):
+        """Until `stop` (a threading / multiprocessing Event) is set."""
+        while stop is None or not stop.is_set():
+            timeout = poll_interval
+            if self.accept_paused_until is not None:
+                timeout = max(0.0, min(timeout, self.accept_paused_until - time.monotonic()))
+                if not timeout:
+                    self.resume_accept()
+                    timeout = poll_interval
+            for key, events in self.selector.select(timeout=timeout):
+                conn = key.data
+                if conn is None:
+                    self.accept()
+                    continue
+                if events & selectors.EVENT_WRITE:
+                    self.flush(conn)
+                if events & selectors.EVENT_READ and conn.sock.fileno() != -1:
+                    self.on_readable(conn)
+        self.close()
+
+    def accept(self):
+        for _ in range(self.accept_batch):
+            try:
+                sock, _ = self.sock.accept()
+            except BlockingIOError:
+                return
+            except OSError as exc:
+                if exc.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM):
+                    logging.warning('accept : %s, %d connections open. Pausing accept for %ss',
+                                    exc.strerror, len(self.open), self.accept_pause)
+                    self.pause_accept()
+                    return
+                # ECONNABORTED, EPROTO .. : that one connection is gone already, take the next
+                continue
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = Connection(sock)
+            self.selector.register(sock, conn.events, conn)
+            self.open.add(conn)
+            self.connections += 1
+
+    def pause_accept(self):
+        self.selector.unregister(self.sock)
+        self.accept_paused_until = time.monotonic() + self.accept_pause
+
+    def resume_accept(self):
+        if self.accept_paused_until is not None:
+            self.accept_paused_until = None
+            self.selector.register(self.sock, selectors.EVENT_READ, None)
+
+    def on_readable(self, conn):
+        try:
+            data = conn.sock.recv(self.recv_size)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.drop(conn)
+            return
+        conn.inbuf += data
+        self.handle(conn)
+        self.flush(conn)
+
+    def handle(self, conn):
+        """Answer every complete request in `inbuf`. Override for another protocol."""
+        inbuf = conn.inbuf
+        start = 0
+        # Over the high water mark, the rest waits in inbuf until the client has read some
+        while conn.out_bytes <= self.high_water and (end := inbuf.find(b'\r\n\r\n', start)) >= 0:
+            request_line = bytes(inbuf[start:inbuf.find(b'\r\n', start)])
+            start = end + 4
+            match = re.match(rb'GET /bytes/(\d+) ', request_line)
+            body = b'x' * int(match.group(1)) if match else HELLO
+            self.send(conn, b'HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n' % len(body), body)
+            self.requests += 1
+        del inbuf[:start]
+        conn.held = conn.out_bytes > self.high_water and b'\r\n\r\n' in inbuf
+
+    def send(self, conn, *buffers):
+        for buffer in buffers:
+            if buffer:
+                conn.out.append(memoryview(buffer))
+                conn.out_bytes += len(buffer)
+
+    def flush(self, conn):
+        out = conn.out
+        while True:
+            while out:
+                try:
+                    sent = conn.sock.sendmsg(list(islice(out, IOV_MAX)))
+                except BlockingIOError:
+                    break
+                except OSError:
+                    self.drop(conn)
+                    return
+                conn.out_bytes -= sent
+                # Drop what went out. The first buffer that went out only partly is replaced by what's left of it.
+                while sent:
+                    head = out[0]
+                    if len(head) <= sent:
+                        sent -= len(head)
+                        out.popleft()
+                    else:
+                        out[0] = head[sent:]
+                        sent = 0
+            if conn.held and conn.out_bytes <= self.low_water:
+                self.handle(conn)
+                continue
+            break
+        if conn.paused:
+            conn.paused = conn.held or conn.out_bytes > self.low_water
+        else:
+            conn.paused = conn.held or conn.out_bytes > self.high_water
+        self.update(conn)
+
+    def update(self, conn):
+        events = 0 if conn.paused else selectors.EVENT_READ
+        if conn.out:
+            events |= selectors.EVENT_WRITE
+        if events != conn.events:
+            # The selector refuses 0 events : a socket we don't want to hear about is unregistered instead
+            if not events:
+                self.selector.unregister(conn.sock)
+            elif not conn.events:
+                self.selector.register(conn.sock, events, conn)
+            else:
+                self.selector.modify(conn.sock, events, conn)
+            conn.events = events
+
+    def drop(self, conn):
+        if conn.events:
+            self.selector.unregister(conn.sock)
+            conn.events = 0
+        conn.sock.close()
+        conn.out.clear()
+        self.open.discard(conn)
+        # A descriptor just got freed
+        self.resume_accept()
+
+    def close(self):
+        self.accept_paused_until = None
+        for conn in list(self.open):
+            self.drop(conn)
+        self.selector.close()
+        self.sock.close()
+
+
+# ---- One process per core ---- #
+def worker_main(host, port, stop, ready, counts, index):
+    server = Server(host, port)
+    ready.release()
+    server.serve_forever(stop)
+    counts[index] = server.requests
+
+class ServerGroup:
+    """`processes` Servers on the same port, thanks to SO_REUSEPORT."""
+    def __init__(self, host='127.0.0.1', port=0, processes=None):
+        self.processes = processes or os.cpu_count()
+        # Pick a free port and hold it (bound, not listening) until the workers have bound it too
+        placeholder = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        placeholder.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        placeholder.bind((host, port))
+        self.placeholder = placeholder
+        self.address = placeholder.getsockname()
+        self.stop = mp.Event()
+        self.counts = mp.Array('q', self.processes)
+        self.workers = []
+
+    def __enter__(self):
+        ready = mp.Semaphore(0)
+        for i in range(self.processes):
+            worker = mp.Process(target=worker_main, args=(*self.address, self.stop, ready, self.counts, i))
+            worker.start()
+            self.workers.append(worker)
+        for _ in self.workers:
+            ready.acquire()
+        self.placeholder.close()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop.set()
+        for worker in self.workers:
+            worker.join()
+
+
+# ---- Load generator over loopback ---- #
+def load_main(url, num_requests, connections, pipeline, done):
+    from http_client_engine import HTTPClientEngine
+    engine = HTTPClientEngine(max_per_host=connections, pipeline=pipeline)
+    requests = [engine.get(url) for _ in range(num_requests)]
+    engine.run()
+    engine.close()
+    done.put(sum(request.response is not None for request in requests))
+
+def load(url, generators=2, num_requests=20_000, connections=32, pipeline=16):
+    """`generators` client processes, each sending `num_requests`. Returns (ok responses, seconds)."""
+    done = mp.Queue()
+    clients = [mp.Process(target=load_main, args=(url, num_requests, connections, pipeline, done)) for _ in range(generators)]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    ok = sum(done.get() for _ in clients)
+    elapsed = time.perf_counter() - start
+    for client in clients:
+        client.join()
+    return ok, elapsed
+
+if __name__ == '__main__':
+    for processes in sorted({1, os.cpu_count()}):
+        with ServerGroup(processes=processes) as group:
+            url = 'http://%s:%d/bytes/512' % group.address
+            ok, elapsed = load(url)
+        print(f'{processes} server process(es) : {ok} responses in {elapsed:.4f}s, {ok / elapsed:,.0f} req/sec, '
+              f'per process {list(group.counts)}')
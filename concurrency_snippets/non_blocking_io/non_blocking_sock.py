@@ -10,12 +10,137 @@ References :
 import logging
 import socket
 import select
-from typing import final
+
+from buffered_sink import BufferedSink
 
 logging.basicConfig(format='%(levelname)s - %(asctime)s: %(message)s',datefmt='%H:%M:%S', level=logging.DEBUG)
 
+"""
+## ====== Receiving without copying everything again and again ====== ##
+The naive loop : `chunk = s.recv(1024).decode(...)` then `data += chunk`.
+- recv(1024) allocates a new bytes object per KiB, then decode allocates a str of it.
+- `data += chunk` may copy everything received so far into a new, longer str. Receiving n bytes costs O(n^2) copying.
+- 1024 bytes per syscall. A 100 MiB response is 100k recv calls.
+
+Receiver :
+- `sock.recv_into(view)` : the kernel copies straight into OUR buffer, no bytes object in between.
+- Without a sink : once the headers are in and say Content-Length, ONE buffer the size of the whole response
+  is allocated, the little received so far is moved into it, and recv_into fills the rest. Nothing is
+  copied again, `result` hands that buffer back as it is.
+- No Content-Length (chunked, or until the server closes) : chunks are collected in a list and joined once,
+  in `result`. So every byte is copied twice, by the kernel and by the join.
+  (Growing one bytearray instead copies what's there on every resize, and zeroes the new room first.)
+- Chunk size adapts : starts at MIN_CHUNK and doubles every time recv fills it completely (more is waiting
+  in the socket buffer), up to MAX_CHUNK.
+- Decoding (if asked) happens once, at the very end.
+- With a sink, every chunk goes from a pooled scratch buffer to the sink, nothing stays in memory.
+  The sink is a `buffered_sink.BufferedSink`, or a file descriptor (wrapped in one). Chunks are coalesced
+  into one writev per MiB instead of a write per chunk.
+"""
+MIN_CHUNK = 16 * 1024
+MAX_CHUNK = 256 * 1024
+
+class BufferPool:
+    """A few MAX_CHUNK scratch buffers, reused instead of allocating 256 KiB per response."""
+    def __init__(self, size=MAX_CHUNK, keep=8):
+        self.size = size
+        self.keep = keep
+        self.free = []
+
+    def get(self):
+        return self.free.pop() if self.free else bytearray(self.size)
+
+    def put(self, buffer):
+        if len(self.free) < self.keep:
+            self.free.append(buffer)
+
+buffer_pool = BufferPool()
+
+def content_length(buffer, fill):
+    """Size of the whole response (headers included), if the headers are complete and have a Content-Length."""
+    end = buffer.find(b'\r\n\r\n', 0, fill)
+    if end < 0:
+        return None
+    for line in bytes(buffer[:end]).split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'content-length' and value.strip().isdigit():
+            return end + 4 + int(value)
+    return None
+
+class Receiver:
+    def __init__(self, sink=None):
+        if isinstance(sink, int):
+            sink = BufferedSink(sink)  # flushed by result(), the descriptor stays open
+            self.wrapped = True
+        else:
+            self.wrapped = False
+        self.sink = sink
+        self.chunk = MIN_CHUNK
+        self.size = 0  # bytes received so far
+        if sink is None:
+            self.chunks = [bytearray(MIN_CHUNK)]
+            self.fill = 0        # bytes in the last chunk
+            self.expected = None # whole response size, once the headers said Content-Length
+        else:
+            self.scratch = buffer_pool.get()
+            self.view = memoryview(self.scratch)
+
+    def recv(self, sock):
+        """
+        One recv_into. Returns the number of bytes received, 0 once the other side closed.
+        On a non-blocking socket with nothing to read it raises BlockingIOError, like recv.
+        """
+        if self.sink is None:
+            last = self.chunks[-1]
+            if self.fill == len(last):
+                # Only without a Content-Length, or a server sending more than it said
+                last = bytearray(self.chunk)
+                self.chunks.append(last)
+                self.fill = 0
+            with memoryview(last)[self.fill:] as view:
+                n = sock.recv_into(view)
+            self.fill += n
+            if self.expected is None and len(self.chunks) == 1:
+                self.expected = content_length(last, self.fill)
+                if self.expected is not None and self.expected > len(last):
+                    whole = bytearray(self.expected)
+                    whole[:self.fill] = last[:self.fill]
+                    self.chunks[0] = whole
+        else:
+            n = sock.recv_into(self.view[:self.chunk])
+            if n:
+                self.sink.write(self.view[:n])  # copied by the sink, the scratch buffer is reused next time
+        self.size += n
+        if n == self.chunk and self.chunk < MAX_CHUNK:
+            self.chunk *= 2
+        return n
+
+    def result(self, encoding=None):
+        """
+        Everything received, or str if `encoding` is given. A bytearray when it all fit in one buffer
+        (no need to copy it into bytes, it's big), bytes otherwise.
+        None when streaming to a sink. A sink we wrapped is flushed, one passed in is left to the caller to close.
+        """
+        if self.sink is not None:
+            if self.wrapped:
+                self.sink.close()
+            self.view.release()
+            buffer_pool.put(self.scratch)
+            return None
+        if len(self.chunks) == 1:
+            data = self.chunks[0]
+            del data[self.fill:]
+        else:
+            with memoryview(self.chunks[-1])[:self.fill] as last:
+                data = b''.join(self.chunks[:-1] + [last])
+        self.chunks = [bytearray()]
+        self.fill = 0
+        if encoding is not None:
+            return data.decode(encoding)
+        return data
+
 # Blocking Socket Example
-def create_blocking(host, ip):
+def create_blocking(host, ip, sink=None, encoding=None, path='/'):
     logging.info('Blocking - Creating Socket')
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
@@ -23,23 +148,23 @@ def create_blocking(host, ip):
     s.connect((host, ip))
 
     logging.info('Blocking - sending')
-    request = f"GET / HTTP/1.1\r\nHost: {host}\r\n\r\n"
+    request = f"GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n"
     s.send(request.encode())
 
 
     logging.info('Waiting for response')
-    data = ""
+    # sink : where to stream the response, e.g. BufferedSink('file.txt'), or a file descriptor
+    receiver = Receiver(sink)
     while True:
-        chunk = s.recv(1024).decode(encoding='ISO-8859-1') # Get first 1024 bytes from the network buffer
-        logging.info(f'Received a chunk of len {len(chunk)}')
-        if not chunk:
+        n = receiver.recv(s) # Whatever is in the network buffer, up to receiver.chunk bytes
+        logging.debug(f'Received a chunk of len {n}')
+        if not n:
             logging.info('Exiting the recv')
             break
-        with open('file.txt', 'a') as f:
-            f.write(data)
-        data += chunk
+    s.close()
 
-    logging.info(f'Got Data of length {len(data)}')
+    logging.info(f'Got Data of length {receiver.size}')
+    return receiver.result(encoding)
 
 """
 ## ====== socket.recv() ====== ##
@@ -65,7 +190,7 @@ Control goes to kernel now. And OS will check if those files (disk file, socket
 During this time period for checking, execution is blocked. Thus, we must provide timeout parameter with select.
 """
 
-def create_non_blocking(host, ip):
+def create_non_blocking(host, ip, sink=None, encoding=None, path='/'):
     logging.info('Non-Blocking - Creating Socket')
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
@@ -85,7 +210,7 @@ def create_non_blocking(host, ip):
     inputs = [s]
     outputs = [s]
 
-    final_data = ''
+    receiver = Receiver(sink)
     while inputs:
         readable, writable, execptional = select.select(inputs, outputs, inputs, 1)
 
@@ -93,7 +218,7 @@ def create_non_blocking(host, ip):
         # Only after sending something, can we get something back to read.
         for s in writable:
             logging.info('Non-Blocking : Send Start')
-            request = f"GET / HTTP/1.1\r\nHost: {host}\r\n\r\n"
+            request = f"GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n"
             data = s.send(request.encode())
             logging.info(f'Non-Blocking : Send End || sent {data}')
             outputs.remove(s)
@@ -102,17 +227,19 @@ def create_non_blocking(host, ip):
         # IF we skip the above writing, The while loop will run infinitely 
         # since socket will always be querying the network buffer. But nothing is there to read from.
         for s in readable:
-            logging.info('Non-Blocking : Read Start')
-            data = s.recv(1024).decode(encoding='ISO-8859-1')
-            logging.info(f'Non-Blocking : Read End :: GOT : {len(data)}')
-            if not data:
+            logging.debug('Non-Blocking : Read Start')
+            try:
+                n = receiver.recv(s)
+            except BlockingIOError:
+                continue
+            logging.debug(f'Non-Blocking : Read End :: GOT : {n}')
+            if not n:
                 logging.info(f'Non-Blocking : Closing Sockets ..')
                 s.close()
                 inputs.remove(s)
                 break
-            final_data += data
-    
-        print('Input length is : ',len(inputs))
+
+        logging.debug(f'Input length is : {len(inputs)}')
         for s in execptional:
             logging.info('Non-Blocking : Exception Start')
             inputs.remove(s)
@@ -120,8 +247,9 @@ def create_non_blocking(host, ip):
             logging.info('Non-Blocking : Exception End')
             break
 
-    import pdb; pdb.set_trace()
-    print('outside while')
+    logging.info(f'Non-Blocking : Got Data of length {receiver.size}')
+    # One socket only. For many connections at once (epoll, keep-alive, pipelining) see `http_client_engine.py`
+    return receiver.result(encoding)
     
 
 def main():
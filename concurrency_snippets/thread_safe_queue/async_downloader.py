@@ -0,0 +1,245 @@
+"""
+Gist :
+Same job as `pooled_downloader.py` (photo JSON lookup, then the thumbnail to `pic{id}.jpg`), on a single event loop.
+A thread per request in flight costs a stack (8 MiB reserved, some of it touched) and a context switch every
+time a socket has data. 10k fetches at once means 10k threads. A coroutine waiting on a socket costs a few KiB.
+
+- Raw `asyncio` streams (`asyncio.open_connection`) and a small HTTP/1.1 client on top : status line,
+  headers, body by Content-Length or chunked. No aiohttp.
+  No body at all for HEAD, 1xx, 204 and 304 (whatever the headers say), else reading it would wait
+  for the server to close a kept alive connection, i.e forever.
+- `concurrency` : an `asyncio.Semaphore` around every fetch. All 10k coroutines can be created up front,
+  only `concurrency` of them have a socket (and a file) open at any time.
+- Keep-alive : connections go back to a per host list when the body was read to the end.
+- Writing to disk blocks. The body is gathered into `chunk_size` pieces, and each piece is written
+  from the default thread pool executor (`run_in_executor`), so the loop keeps serving other sockets.
+"""
+import asyncio
+import json
+import os
+import tempfile
+import time
+from urllib.parse import urljoin, urlsplit
+
+from local_http_server import LocalServer
+
+REDIRECTS = {301, 302, 303, 307, 308}
+
+
+class HTTPError(Exception):
+    pass
+
+
+class Response:
+    def __init__(self, downloader, key, reader, writer, status, reason, headers, version='HTTP/1.1', method='GET'):
+        self.downloader = downloader
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.version = version
+        self.method = method
+        self.status = status
+        self.reason = reason
+        self.headers = headers  # lower cased names
+        self.done = False
+
+    @property
+    def has_body(self):
+        return self.method != 'HEAD' and self.status >= 200 and self.status not in (204, 304)
+
+    @property
+    def keep_alive(self):
+        # HTTP/1.1 keeps the connection unless told otherwise, HTTP/1.0 closes it unless told otherwise
+        tokens = {token.strip() for token in self.headers.get('connection', '').lower().split(',')}
+        if self.version == 'HTTP/1.0':
+            return 'keep-alive' in tokens
+        return 'close' not in tokens
+
+    async def chunks(self, size):
+        """Yields the body in pieces of at most `size` bytes. Gives the connection back at the end."""
+        reader = self.reader
+        try:
+            if not self.has_body:
+                reusable = True
+            elif self.headers.get('transfer-encoding', '').lower() == 'chunked':
+                while True:
+                    line = await reader.readuntil(b'\r\n')
+                    length = int(line.split(b';', 1)[0], 16)
+                    if length == 0:
+                        # Trailers, until the empty line
+                        while await reader.readuntil(b'\r\n') != b'\r\n':
+                            pass
+                        break
+                    while length:
+                        piece = await reader.read(min(length, size))
+                        if not piece:
+                            raise asyncio.IncompleteReadError(b'', length)
+                        length -= len(piece)
+                        yield piece
+                    await reader.readexactly(2)
+                reusable = True
+            elif 'content-length' in self.headers:
+                remaining = int(self.headers['content-length'])
+                while remaining:
+                    piece = await reader.read(min(remaining, size))
+                    if not piece:
+                        raise asyncio.IncompleteReadError(b'', remaining)
+                    remaining -= len(piece)
+                    yield piece
+                reusable = True
+            else:
+                # Body ends when the server closes the connection
+                while piece := await reader.read(size):
+                    yield piece
+                reusable = False
+        except BaseException:
+            self.release(False)
+            raise
+        self.release(reusable and self.keep_alive)
+
+    async def read(self):
+        return b''.join([piece async for piece in self.chunks(1 << 16)])
+
+    def release(self, reusable):
+        if not self.done:
+            self.done = True
+            self.downloader.release(self.key, self.reader, self.writer, reusable)
+
+
+class AsyncDownloader:
+    def __init__(self, concurrency=100, keepalive=None, chunk_size=256 * 1024):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        # Idle connections kept per host. Less than `concurrency` means closing connections we'll want right away.
+        self.keepalive = concurrency if keepalive is None else keepalive
+        self.chunk_size = chunk_size
+        self.idle = {}  # (scheme, host, port) -> [(reader, writer)]
+
+    async def connect(self, key):
+        """Returns (reader, writer, reused)."""
+        idle = self.idle.get(key)
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        reader, writer = await self.dial(key)
+        return reader, writer, False
+
+    async def dial(self, key):
+        scheme, host, port = key
+        return await asyncio.open_connection(host, port, ssl=scheme == 'https')
+
+    def release(self, key, reader, writer, reusable):
+        idle = self.idle.setdefault(key, [])
+        if reusable and len(idle) < self.keepalive:
+            idle.append((reader, writer))
+        else:
+            writer.close()
+
+    async def send(self, key, reader, writer, target, host, method='GET'):
+        writer.write(f'{method} {target} HTTP/1.1\r\nHost: {host}\r\nAccept: */*\r\n\r\n'.encode('latin-1'))
+        await writer.drain()
+        head = await reader.readuntil(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        version, status, reason = (lines[0].split(' ', 2) + [''])[:3]
+        headers = {}
+        for line in lines[1:]:
+            if line:
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+        return Response(self, key, reader, writer, int(status), reason, headers, version, method)
+
+    async def open(self, url, max_redirects=5, method='GET'):
+        """GET (or HEAD ..) `url`. Returns a Response, it's body not read yet."""
+        for _ in range(max_redirects + 1):
+            parts = urlsplit(url)
+            port = parts.port or (443 if parts.scheme == 'https' else 80)
+            key = (parts.scheme, parts.hostname, port)
+            target = parts.path or '/'
+            if parts.query:
+                target += '?' + parts.query
+            reader, writer, reused = await self.connect(key)
+            try:
+                response = await self.send(key, reader, writer, target, parts.netloc, method)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                if not reused:
+                    raise
+                # Server closed the kept alive connection while it sat in the pool. Once more on a new one.
+                reader, writer = await self.dial(key)
+                response = await self.send(key, reader, writer, target, parts.netloc, method)
+            if response.status not in REDIRECTS:
+                return response
+            await response.read()
+            url = urljoin(url, response.headers.get('location', ''))
+        raise HTTPError(f'Too many redirects for {url}')
+
+    def close(self):
+        for idle in self.idle.values():
+            for _, writer in idle:
+                writer.close()
+        self.idle.clear()
+
+    # ---- Jobs ---- #
+    async def get_json(self, url):
+        async with self.semaphore:
+            response = await self.open(url)
+            body = await response.read()
+        if response.status != 200:
+            raise HTTPError(f'{url} : {response.status} {response.reason}')
+        return json.loads(body)
+
+    async def save(self, url, path):
+        """Stream `url` into `path`. Returns the number of bytes written."""
+        loop = asyncio.get_running_loop()
+        async with self.semaphore:
+            response = await self.open(url)
+            if response.status != 200:
+                await response.read()
+                raise HTTPError(f'{url} : {response.status} {response.reason}')
+            try:
+                file = await loop.run_in_executor(None, open, path, 'wb')
+            except BaseException:
+                # Body not read : the connection can't be reused
+                response.release(False)
+                raise
+            try:
+                written = 0
+                pending = []
+                size = 0
+                async for piece in response.chunks(self.chunk_size):
+                    pending.append(piece)
+                    size += len(piece)
+                    if size >= self.chunk_size:
+                        await loop.run_in_executor(None, file.write, b''.join(pending))
+                        written += size
+                        pending, size = [], 0
+                if pending:
+                    await loop.run_in_executor(None, file.write, b''.join(pending))
+                    written += size
+            finally:
+                await loop.run_in_executor(None, file.close)
+        return written
+
+    async def download_photo(self, iden, base_url='https://jsonplaceholder.typicode.com', directory='.'):
+        photo = await self.get_json(f'{base_url}/photos/{iden}')
+        return await self.save(photo['thumbnailUrl'], os.path.join(directory, f'pic{iden}.jpg'))
+
+
+NUM_PHOTOS = 10_000
+
+async def main(base_url, directory):
+    downloader = AsyncDownloader(concurrency=200)
+    try:
+        # All of them at once. The semaphore decides how many are on the wire.
+        sizes = await asyncio.gather(*(downloader.download_photo(i, base_url, directory) for i in range(1, NUM_PHOTOS + 1)))
+    finally:
+        downloader.close()
+    return sum(sizes)
+
+if __name__ == '__main__':
+    with LocalServer(image_size=16 * 1024) as server, tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        total = asyncio.run(main(server.url, directory))
+        elapsed = time.perf_counter() - start
+        print(f'{NUM_PHOTOS} photos  {elapsed:.4f}s  {total / 2**20:.1f} MiB  {server.connections} connections')
@@ -0,0 +1,184 @@
+"""
+Gist :
+`producer_consumer.py` runs with `max_workers=5`, `thread_safe_queue.py` with `NUM_THREADS = 10`. Pick too few
+and a burst of logs piles up in the queue, pick too many and most of them sit in `get()` doing nothing.
+
+Here a supervisor thread picks the number of consumers instead. Every `interval` it looks at :
+- depth : how many messages are waiting in the queue.
+- service time : how long a consumer takes per message (moving average, measured by the consumers).
+- idle : fraction of the last interval consumers spent waiting in `get()`.
+
+Scale up : `depth * service_time / workers` is how long the backlog takes to drain with what we have.
+If that's above `target_latency`, add enough consumers to drain it in time (up to `max_workers`).
+Scale down : if consumers were idle more than `idle_high` of the time, retire one (down to `min_workers`).
+
+Hysteresis, so a pool doesn't flap up and down on every sample :
+- Both conditions have to hold for `patience` samples in a row.
+- After resizing, we wait `cooldown` seconds before the next change.
+- The two thresholds are far apart : we only shrink when the queue is also empty.
+"""
+import logging
+import math
+import queue
+import random
+import threading
+import time
+
+SENTINEL = object()
+
+
+class AutoscalingPipeline:
+    """
+    `handler(message)` is called for every message, from the consumer threads.
+    """
+    def __init__(self, handler, min_workers=1, max_workers=16, maxsize=0, interval=0.1,
+                 target_latency=0.5, idle_high=0.5, patience=3, cooldown=0.5):
+        if not 0 < min_workers <= max_workers:
+            raise ValueError('Need 0 < min_workers <= max_workers')
+        self.handler = handler
+        self.min_workers = min_workers
+        self.max_workers = max_workers
+        self.queue = queue.Queue(maxsize)
+        self.interval = interval
+        self.target_latency = target_latency
+        self.idle_high = idle_high
+        self.patience = patience
+        self.cooldown = cooldown
+
+        self.lock = threading.Lock()  # protects everything below
+        self.workers = 0
+        self.retiring = 0             # consumers asked to exit
+        self.service_time = 0.0       # moving average, seconds per message
+        self.idle = 0.0               # seconds spent waiting in get() since the last sample
+        self.threads = []             # consumers still running. A consumer removes itself when it exits.
+        self.spawned = 0
+        self.closed = threading.Event()
+        self.supervisor = threading.Thread(target=self.supervise, name='supervisor')
+
+    def start(self):
+        with self.lock:
+            self.spawn(self.min_workers)
+        self.supervisor.start()
+        return self
+
+    def set_message(self, message, name):
+        self.queue.put(message)
+
+    def close(self):
+        """No more messages. Consumers drain the queue, then exit."""
+        self.closed.set()
+        self.supervisor.join()
+        # One sentinel per consumer still around. Each one takes one and exits.
+        with self.lock:
+            remaining = self.workers - self.retiring
+        for _ in range(remaining):
+            self.queue.put(SENTINEL)
+
+    def join(self):
+        while True:
+            with self.lock:
+                if not self.threads:
+                    return
+                thread = self.threads[0]
+            thread.join()
+
+    # ---- Consumers ---- #
+    def spawn(self, n):
+        # Called with self.lock held
+        for _ in range(n):
+            thread = threading.Thread(target=self.consume, name=f'consumer-{self.spawned}')
+            self.spawned += 1
+            self.workers += 1
+            self.threads.append(thread)
+            thread.start()
+
+    def consume(self):
+        while True:
+            waited = time.perf_counter()
+            try:
+                # Timeout, so a consumer that should retire notices even when the queue stays empty
+                message = self.queue.get(timeout=self.interval)
+            except queue.Empty:
+                message = None
+            started = time.perf_counter()
+            with self.lock:
+                self.idle += started - waited
+                if message is None and self.retiring:
+                    self.retiring -= 1
+                    self.exit()
+                    return
+            if message is None:
+                continue
+            if message is SENTINEL:
+                with self.lock:
+                    self.exit()
+                return
+            self.handler(message)
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.service_time = 0.8 * self.service_time + 0.2 * elapsed if self.service_time else elapsed
+
+    def exit(self):
+        # Called with self.lock held, by the consumer that's exiting
+        self.workers -= 1
+        self.threads.remove(threading.current_thread())
+
+    # ---- Supervisor ---- #
+    def supervise(self):
+        up = down = 0
+        last_change = time.perf_counter()
+        last_sample = last_change
+        while not self.closed.wait(self.interval):
+            now = time.perf_counter()
+            depth = self.queue.qsize()
+            with self.lock:
+                workers = self.workers - self.retiring
+                service_time = self.service_time
+                window = (now - last_sample) * max(workers, 1)
+                idle = min(self.idle / window, 1.0) if window else 0.0
+                self.idle = 0.0
+            last_sample = now
+
+            drain_time = depth * service_time / max(workers, 1)
+            up = up + 1 if drain_time > self.target_latency and workers < self.max_workers else 0
+            down = down + 1 if depth == 0 and idle > self.idle_high and workers > self.min_workers else 0
+            if now - last_change < self.cooldown:
+                continue
+
+            if up >= self.patience:
+                wanted = math.ceil(depth * service_time / self.target_latency)
+                add = max(1, min(wanted, self.max_workers) - workers)
+                with self.lock:
+                    self.spawn(add)
+                logging.info("depth %d, drain %.2fs : %d -> %d consumers", depth, drain_time, workers, workers + add)
+            elif down >= self.patience:
+                with self.lock:
+                    self.retiring += 1
+                logging.info("idle %.0f%% : %d -> %d consumers", idle * 100, workers, workers - 1)
+            else:
+                continue
+            up = down = 0
+            last_change = now
+
+
+# ---- Bursty log ingestion ---- #
+def handle_log(message):
+    # Pretend we're writing to the database. Mostly waiting on I/O, so threads do help.
+    time.sleep(0.005)
+
+def bursty_producer(pipeline, bursts=3):
+    for _ in range(bursts):
+        for _ in range(random.randint(400, 600)):
+            pipeline.set_message(random.randint(1, 101), "Producer")
+        # Quiet period
+        time.sleep(2)
+
+if __name__ == "__main__":
+    format = "%(asctime)s: %(message)s"
+    logging.basicConfig(format=format, level=logging.INFO,
+                        datefmt="%H:%M:%S")
+
+    pipeline = AutoscalingPipeline(handle_log, min_workers=1, max_workers=32).start()
+    bursty_producer(pipeline)
+    pipeline.close()
+    pipeline.join()
@@ -0,0 +1,75 @@
+"""
+Throughput of the `Queue` from `thread_safe_queue.py` : one item at a time (put / get) 
+vs batches (put_many / get_many), with several producers and consumers.
+
+With the one item API, every message costs a lock handoff and a notify on both sides.
+With batches, that cost is paid once per batch.
+"""
+import threading
+import time
+
+from thread_safe_queue import Queue
+
+NUM_PRODUCERS = 4
+NUM_CONSUMERS = 4
+NUM_MESSAGES = 50_000 # per producer
+BATCH_SIZE = 100
+MAXSIZE = 1_000
+
+SENTINEL = object()
+
+def producer_single(q):
+    for i in range(NUM_MESSAGES):
+        q.put(i)
+
+def consumer_single(q, counts):
+    count = 0
+    while True:
+        message = q.get()
+        if message is SENTINEL:
+            break
+        count += 1
+    counts.append(count)
+
+def producer_batched(q):
+    for start in range(0, NUM_MESSAGES, BATCH_SIZE):
+        q.put_many(range(start, min(start + BATCH_SIZE, NUM_MESSAGES)))
+
+def consumer_batched(q, counts):
+    count = 0
+    while True:
+        messages = q.get_many(BATCH_SIZE)
+        sentinels = messages.count(SENTINEL)
+        count += len(messages) - sentinels
+        if sentinels:
+            # Sentinels only come after all the messages. We took one, put back the ones meant for other consumers.
+            q.put_many([SENTINEL] * (sentinels - 1))
+            break
+    counts.append(count)
+
+def run(producer, consumer):
+    q = Queue(MAXSIZE)
+    counts = []
+    producers = [threading.Thread(target=producer, args=(q,)) for _ in range(NUM_PRODUCERS)]
+    consumers = [threading.Thread(target=consumer, args=(q, counts)) for _ in range(NUM_CONSUMERS)]
+    start = time.perf_counter()
+    for t in producers + consumers:
+        t.start()
+    for t in producers:
+        t.join()
+    for _ in consumers:
+        q.put(SENTINEL)
+    for t in consumers:
+        t.join()
+    elapsed = time.perf_counter() - start
+    assert sum(counts) == NUM_PRODUCERS * NUM_MESSAGES
+    return elapsed
+
+if __name__ == '__main__':
+    total = NUM_PRODUCERS * NUM_MESSAGES
+    for name, producer, consumer in [
+        ('put / get', producer_single, consumer_single),
+        (f'put_many / get_many ({BATCH_SIZE})', producer_batched, consumer_batched),
+    ]:
+        elapsed = run(producer, consumer)
+        print(f'{name:<28} {elapsed:.4f}s  {total / elapsed:,.0f} messages/sec')
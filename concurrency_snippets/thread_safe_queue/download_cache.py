@@ -0,0 +1,287 @@
+"""
+Gist :
+Every run of the thumbnails job fetches every photo JSON and every image again, even though they hardly ever change.
+DownloadCache keeps the bodies on disk between runs and remembers how to ask the server "has it changed?".
+
+Layout :
+    directory/
+        index.json        url -> {digest, size, etag, last_modified, validated}. In LRU order, oldest first.
+        objects/ab/cdef.. body, named after the sha256 of it's content
+
+- Content addressed : the same bytes behind two urls are stored once. An object is only deleted when no url points at it.
+- Revalidation : for a known url, the request carries `If-None-Match` (ETag) / `If-Modified-Since` (Last-Modified).
+  If nothing changed the server answers `304 Not Modified` with no body, and we use what's on disk.
+- `max_age` : seconds during which an entry is trusted without asking at all. 0 means always revalidate
+  (one small round trip, no body). With max_age, a rerun makes no requests for what it fetched recently.
+- `max_bytes` : when the objects take more than that, least recently used urls are dropped until they fit.
+- Atomic writes : objects and the index are written to a temporary file in the same directory, fsync'd,
+  `os.replace`d, and then the directory is fsync'd too (the rename is only on disk after that). A crash or a
+  power cut leaves either the old file or the new one, never half of one. Costs an fsync or two per object stored.
+- Evicted objects are only deleted once an index without them is on disk. Still, an object can go missing
+  (deleted by hand ..) : a url whose object is gone is treated as a miss and fetched again.
+- The other way around, objects no url in the index points at (stored, but the process died before the index
+  was written) and leftover temporary files are deleted when the cache is opened. Nothing else would ever count them.
+- Lookups hand back an OPEN file, opened under the lock. Evicting the object afterwards (another worker
+  storing something) only unlinks the name, the reader still has it's file.
+
+Thread safe (the Downloader workers share one). NOT meant to be shared by several processes.
+"""
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+
+def fsync_directory(path):
+    # Makes a rename / new file in `path` durable. Directories can't be opened like this on Windows.
+    if os.name != 'posix':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class DownloadCache:
+    def __init__(self, directory, max_bytes=256 * 2**20, max_age=0, flush_every=100):
+        self.directory = directory
+        self.objects = os.path.join(directory, 'objects')
+        self.index_path = os.path.join(directory, 'index.json')
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.flush_every = flush_every
+        self.lock = threading.Lock()
+        self.dirty = 0
+        self.garbage = []  # digests no url points at anymore, deleted after the next index write
+        os.makedirs(self.objects, exist_ok=True)
+
+        self.index = OrderedDict()
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as file:
+                self.index.update(json.load(file))
+        self.refs = {}
+        self.sizes = {}
+        for entry in self.index.values():
+            self.refs[entry['digest']] = self.refs.get(entry['digest'], 0) + 1
+            self.sizes[entry['digest']] = entry['size']
+        self.total = sum(self.sizes.values())
+        self.sweep()
+
+    def sweep(self):
+        # Objects that aren't in the index (it wasn't flushed before a crash) and temporary files left behind
+        for name in os.listdir(self.directory):
+            if name.startswith('.index-'):
+                os.unlink(os.path.join(self.directory, name))
+        for prefix in os.listdir(self.objects):
+            directory = os.path.join(self.objects, prefix)
+            if not os.path.isdir(directory):
+                if prefix.startswith('.part-'):
+                    os.unlink(directory)
+                continue
+            for name in os.listdir(directory):
+                if prefix + name not in self.refs:
+                    os.unlink(os.path.join(directory, name))
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest[2:])
+
+    # ---- Lookups ---- #
+    def lookup(self, url):
+        """
+        For a known url, returns (file, request headers). `file` is the body, open for reading, if the entry
+        is still fresh. None if it has to be revalidated first : send the headers, and call `revalidated` on a 304.
+        Returns None for an unknown url.
+        """
+        with self.lock:
+            entry = self.index.get(url)
+            if entry is None:
+                return None
+            headers = {}
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+            if time.time() - entry['validated'] >= self.max_age:
+                return None, headers
+            file = self.open_object(url, entry)
+            if file is None:
+                return None
+            self.touch(url)
+            return file, headers
+
+    def revalidated(self, url):
+        """
+        Server said 304. Returns what we have, open for reading.
+        None if it's not there anymore (evicted since `lookup`, or the object is gone) : fetch it again, unconditionally.
+        """
+        with self.lock:
+            entry = self.index.get(url)
+            if entry is None:
+                return None
+            file = self.open_object(url, entry)
+            if file is None:
+                return None
+            entry['validated'] = time.time()
+            self.touch(url)
+            return file
+
+    def open_object(self, url, entry):
+        # Called with self.lock held. A missing object makes the entry a miss.
+        try:
+            return open(self.object_path(entry['digest']), 'rb')
+        except FileNotFoundError:
+            del self.index[url]
+            self.unref(entry['digest'])
+            self.changed()
+            return None
+
+    def touch(self, url):
+        # Called with self.lock held
+        self.index.move_to_end(url)
+        self.changed()
+
+    # ---- Storing ---- #
+    def store(self, url, response, chunk_size=256 * 1024):
+        """
+        Read `response` (anything with `readinto` and `getheader`, e.g. http.client.HTTPResponse)
+        into the cache. Returns the object, open for reading.
+        """
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        digest = hashlib.sha256()
+        size = 0
+        file = tempfile.NamedTemporaryFile(dir=self.objects, prefix='.part-', delete=False)
+        try:
+            with file:
+                while n := response.readinto(view):
+                    file.write(view[:n])
+                    digest.update(view[:n])
+                    size += n
+                file.flush()
+                os.fsync(file.fileno())
+        except BaseException:
+            os.unlink(file.name)
+            raise
+
+        digest = digest.hexdigest()
+        path = self.object_path(digest)
+        with self.lock:
+            # Under the lock, so an eviction of the same digest can't unlink it right after
+            # Same content already there : replacing it with identical bytes is harmless
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+                fsync_directory(self.objects)
+            os.replace(file.name, path)
+            fsync_directory(os.path.dirname(path))
+            old = self.index.pop(url, None)
+            if old is not None:
+                self.unref(old['digest'])
+            self.index[url] = {
+                'digest': digest,
+                'size': size,
+                'etag': response.getheader('ETag'),
+                'last_modified': response.getheader('Last-Modified'),
+                'validated': time.time(),
+            }
+            if digest not in self.refs:
+                self.refs[digest] = 0
+                self.sizes[digest] = size
+                self.total += size
+            self.refs[digest] += 1
+            file = open(path, 'rb')
+            self.evict(keep=url)
+            if self.garbage:
+                # The index on disk may still point at them. Write it first, then delete.
+                self.write_index()
+            else:
+                self.changed()
+        return file
+
+    def unref(self, digest):
+        # Called with self.lock held
+        self.refs[digest] -= 1
+        if self.refs[digest]:
+            return
+        del self.refs[digest]
+        self.total -= self.sizes.pop(digest)
+        self.garbage.append(digest)
+
+    def collect(self):
+        # Called with self.lock held, right after the index was written.
+        # A digest may have been stored again in the meantime, those stay.
+        for digest in self.garbage:
+            if digest not in self.refs:
+                try:
+                    os.unlink(self.object_path(digest))
+                except FileNotFoundError:
+                    pass
+        self.garbage = []
+
+    def evict(self, keep):
+        # Called with self.lock held. Least recently used first, never the one we just stored.
+        while self.total > self.max_bytes and len(self.index) > 1:
+            url = next(iter(self.index))
+            if url == keep:
+                self.index.move_to_end(url)
+                continue
+            self.unref(self.index.pop(url)['digest'])
+
+    # ---- Index on disk ---- #
+    def changed(self):
+        # Called with self.lock held
+        self.dirty += 1
+        if self.dirty >= self.flush_every:
+            self.write_index()
+
+    def write_index(self):
+        # Called with self.lock held
+        file = tempfile.NamedTemporaryFile('w', dir=self.directory, prefix='.index-', delete=False)
+        try:
+            with file:
+                json.dump(self.index, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(file.name, self.index_path)
+            fsync_directory(self.directory)
+        except BaseException:
+            os.unlink(file.name)
+            raise
+        self.dirty = 0
+        self.collect()
+
+    def flush(self):
+        with self.lock:
+            if self.dirty or self.garbage:
+                self.write_index()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# ---- Three runs of the same batch job ---- #
+NUM_PHOTOS = 300
+
+if __name__ == '__main__':
+    from local_http_server import LocalServer
+    from pooled_downloader import Downloader
+
+    with LocalServer(image_size=64 * 1024) as server, tempfile.TemporaryDirectory() as directory:
+        cache_dir = os.path.join(directory, 'cache')
+        for name, max_age in ('cold cache', 0), ('revalidate (max_age=0)', 0), ('fresh (max_age=3600)', 3600):
+            before = server.requests
+            start = time.perf_counter()
+            with DownloadCache(cache_dir, max_age=max_age) as cache, Downloader(num_workers=8, cache=cache) as downloader:
+                futures = [downloader.submit(downloader.download_photo, i, server.url, directory) for i in range(1, NUM_PHOTOS + 1)]
+                total = sum(future.result() for future in futures)
+            elapsed = time.perf_counter() - start
+            print(f'{name:<24} {elapsed:.4f}s  {total / 2**20:.1f} MiB  {server.requests - before} requests')
@@ -0,0 +1,174 @@
+"""
+Stand-in for jsonplaceholder.typicode.com and the image host, so the download snippets can run
+(and be timed) without the network.
+
+- /photos/{id}      : JSON like jsonplaceholder's. `thumbnailUrl` points back to this server.
+- /thumbs/{id}.jpg  : `image_size` bytes of fake image.
+
+Raw bodies, for the socket level clients in non_blocking_io/ (no ETag, they can be big) :
+- /bytes/{n}        : n bytes, with a Content-Length
+- /chunked/{n}      : n bytes, Transfer-Encoding: chunked (1000 byte chunks)
+- /close/{n}        : n bytes, then the server closes the connection (Connection: close)
+- /eof/{n}          : n bytes with no Content-Length, the body ends when the server closes the connection
+
+Speaks HTTP/1.1, so connections are kept alive between requests. `connections` counts how many TCP
+connections the server accepted and `requests` how many requests it served. Handy to see if a client reuses connections.
+Requests on a connection are answered in order, so pipelining works too.
+
+Every answer has an ETag and a Last-Modified (when the server started). A request with a matching
+`If-None-Match` / `If-Modified-Since` gets `304 Not Modified` and no body.
+
+`tail_fraction` of the requests (picked at random) wait `tail_delay` seconds before answering.
+Real servers have a slow tail like that : GC pauses, a cold cache, a noisy neighbour ..
+
+    with LocalServer() as server:
+        ... fetch f'{server.url}/photos/1' ... or connect to server.address
+"""
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+
+def image_bytes(iden, size):
+    pattern = f'{iden:08d}'.encode()
+    return (pattern * (size // len(pattern) + 1))[:size]
+
+
+def payload(n):
+    return (b'0123456789abcdef' * (n // 16 + 1))[:n]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in two writes. With Nagle on, the body waits for the client's delayed ACK
+    # (~40ms) on every kept alive request.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+        if random.random() < self.server.tail_fraction:
+            time.sleep(self.server.tail_delay)
+        path = urlsplit(self.path).path
+        if match := re.fullmatch(r'/photos/(\d+)', path):
+            iden = int(match.group(1))
+            body = json.dumps({
+                'id': iden,
+                'title': f'photo {iden}',
+                'url': f'http://{self.headers["Host"]}/thumbs/{iden}.jpg',
+                'thumbnailUrl': f'http://{self.headers["Host"]}/thumbs/{iden}.jpg',
+            }).encode()
+            content_type = 'application/json'
+        elif match := re.fullmatch(r'/thumbs/(\d+)\.jpg', path):
+            body = image_bytes(int(match.group(1)), self.server.image_size)
+            content_type = 'image/jpeg'
+        elif match := re.fullmatch(r'/(bytes|chunked|close|eof)/(\d+)', path):
+            self.send_raw(match.group(1), payload(int(match.group(2))))
+            return
+        else:
+            self.send_error(404)
+            return
+        etag = f'"{hashlib.sha1(body).hexdigest()[:16]}"'
+        if self.not_modified(etag):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', self.server.last_modified)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_raw(self, kind, body):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        if kind == 'chunked':
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for start in range(0, len(body), 1000):
+                piece = body[start:start + 1000]
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(piece), piece))
+            self.wfile.write(b'0\r\n\r\n')
+            return
+        if kind == 'eof':
+            self.close_connection = True
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.send_header('Content-Length', str(len(body)))
+        if kind == 'close':
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+        self.wfile.write(body)
+
+    def not_modified(self, etag):
+        if 'If-None-Match' in self.headers:
+            return etag in self.headers['If-None-Match']
+        if 'If-Modified-Since' in self.headers:
+            try:
+                since = parsedate_to_datetime(self.headers['If-Modified-Since'])
+            except (TypeError, ValueError):
+                return False
+            return since >= parsedate_to_datetime(self.server.last_modified)
+        return False
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Server(ThreadingHTTPServer):
+    # Default listen backlog is 5. Hundreds of clients connecting at once get reset.
+    request_queue_size = 1024
+
+    def handle_error(self, request, client_address):
+        # Clients that gave up (timeouts, the losing hedged request ..) are expected here
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class LocalServer:
+    def __init__(self, image_size=64 * 1024, tail_delay=0.0, tail_fraction=0.0):
+        self.httpd = Server(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.httpd.lock = threading.Lock()
+        self.httpd.connections = 0
+        self.httpd.requests = 0
+        self.httpd.image_size = image_size
+        self.httpd.tail_delay = tail_delay
+        self.httpd.tail_fraction = tail_fraction
+        self.httpd.last_modified = formatdate(time.time(), usegmt=True)
+        self.address = host, port = self.httpd.server_address
+        self.url = f'http://{host}:{port}'
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def connections(self):
+        return self.httpd.connections
+
+    @property
+    def requests(self):
+        return self.httpd.requests
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
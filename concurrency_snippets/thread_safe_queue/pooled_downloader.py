@@ -0,0 +1,309 @@
+"""
+Gist :
+`download` in `thread_safe_queue.py` starts a thread per photo. The thread calls `requests.get` twice
+(the JSON lookup, then the image) and exits. No Session, so every call opens a new TCP (and TLS) connection :
+a handshake per request, and for small thumbnails the handshake is most of the time.
+
+Downloader here :
+- Long lived workers. A fixed number of threads (`num_workers`) pull jobs from a queue, so that's also
+  the limit on requests in flight. `submit` returns a `concurrent.futures.Future`.
+- ConnectionPool. Keeps finished connections per host (scheme + host + port) and hands them to the next
+  request for the same host. At most `max_per_host` connections to a host at once, at most `keepalive`
+  of them kept idle. Built on `http.client`, no `requests` needed.
+- Streamed writes. The body is read straight into a `chunk_size` buffer (`readinto`) and handed to a
+  `buffered_sink.BufferedSink`, which writes it out with one writev per `sink_buffer` bytes.
+  `fsync_interval` and `direct` (O_DIRECT) are passed on to it.
+
+A keep-alive connection can be closed by the server while it sits in the pool. We only find out when we
+use it, so a request on a *reused* connection that fails that way is retried once on a fresh one.
+
+Timeouts : `timeout` is either one number, or (connect, read) like in `requests`. The read timeout is per
+`recv`, so a server that drips a byte every few seconds never hits it. `deadline` caps a whole download.
+Retries and hedged requests live in `request_policy.py`, pass a RequestPolicy as `policy`.
+To skip downloads that didn't change since the last run, pass a `download_cache.DownloadCache` as `cache`.
+
+Run this file to compare against a connection per request, on `local_http_server.LocalServer`.
+"""
+import http.client
+import json
+import os
+import queue
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from urllib.parse import urljoin, urlsplit
+
+from local_http_server import LocalServer
+
+# The file writing is shared with the socket fetchers in non_blocking_io/
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'non_blocking_io'))
+from buffered_sink import BufferedSink
+
+# The server closed a kept alive connection before we used it
+STALE = (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError)
+
+REDIRECTS = {301, 302, 303, 307, 308}
+
+
+class HTTPStatusError(http.client.HTTPException):
+    def __init__(self, url, status, reason):
+        super().__init__(f'{url} : {status} {reason}')
+        self.status = status
+
+
+class HostPool:
+    def __init__(self, max_connections, keepalive):
+        self.keepalive = keepalive
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.idle = []  # LIFO : the most recently used connection is the least likely to be closed already
+        self.lock = threading.Lock()
+
+
+class ConnectionPool:
+    def __init__(self, max_per_host=4, keepalive=4, timeout=None):
+        self.max_per_host = max_per_host
+        self.keepalive = keepalive
+        if not isinstance(timeout, tuple):
+            timeout = (timeout, timeout)
+        self.connect_timeout, self.read_timeout = timeout
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def host(self, key):
+        with self.lock:
+            if key not in self.hosts:
+                self.hosts[key] = HostPool(self.max_per_host, self.keepalive)
+            return self.hosts[key]
+
+    def connect(self, scheme, netloc):
+        if scheme == 'https':
+            return http.client.HTTPSConnection(netloc, timeout=self.connect_timeout)
+        return http.client.HTTPConnection(netloc, timeout=self.connect_timeout)
+
+    def open_socket(self, conn):
+        # http.client would connect on it's own, but then the read timeout would be the connect timeout
+        if conn.sock is None:
+            conn.connect()
+            conn.sock.settimeout(self.read_timeout)
+
+    def acquire(self, scheme, netloc):
+        """Returns (connection, reused)."""
+        pool = self.host((scheme, netloc))
+        pool.slots.acquire()
+        with pool.lock:
+            if pool.idle:
+                return pool.idle.pop(), True
+        return self.connect(scheme, netloc), False
+
+    def release(self, scheme, netloc, conn, reusable):
+        pool = self.host((scheme, netloc))
+        with pool.lock:
+            if reusable and len(pool.idle) < pool.keepalive:
+                pool.idle.append(conn)
+                conn = None
+        if conn is not None:
+            conn.close()
+        pool.slots.release()
+
+    @contextmanager
+    def urlopen(self, url, headers=None, max_redirects=5):
+        """
+        GET `url`, yields the `http.client.HTTPResponse`. Follows redirects.
+        The connection goes back to the pool only if the body was read to the end.
+        """
+        for _ in range(max_redirects + 1):
+            parts = urlsplit(url)
+            target = parts.path or '/'
+            if parts.query:
+                target += '?' + parts.query
+            conn, reused = self.acquire(parts.scheme, parts.netloc)
+            try:
+                try:
+                    self.open_socket(conn)
+                    conn.request('GET', target, headers=headers or {})
+                    response = conn.getresponse()
+                except STALE:
+                    if not reused:
+                        raise
+                    conn.close()
+                    self.open_socket(conn)
+                    conn.request('GET', target, headers=headers or {})
+                    response = conn.getresponse()
+                location = None
+                if response.status in REDIRECTS:
+                    response.read()
+                    location = response.getheader('Location')
+                else:
+                    yield response
+            except BaseException:
+                self.release(parts.scheme, parts.netloc, conn, False)
+                raise
+            # Fully read body : http.client closes the response, and the connection is free for the next request
+            self.release(parts.scheme, parts.netloc, conn, response.isclosed() and not response.will_close)
+            if location is None:
+                return
+            url = urljoin(url, location)
+        raise http.client.HTTPException(f'Too many redirects for {url}')
+
+    def close(self):
+        with self.lock:
+            hosts = list(self.hosts.values())
+        for pool in hosts:
+            with pool.lock:
+                idle, pool.idle = pool.idle, []
+            for conn in idle:
+                conn.close()
+
+
+class Downloader:
+    def __init__(self, num_workers=8, max_per_host=4, keepalive=4, chunk_size=256 * 1024, timeout=None,
+                 deadline=None, policy=None, cache=None, sink_buffer=1 << 20, fsync_interval=None, direct=False):
+        self.pool = ConnectionPool(max_per_host, keepalive, timeout)
+        self.chunk_size = chunk_size
+        self.sink_options = {'buffer_size': sink_buffer, 'fsync_interval': fsync_interval, 'direct': direct}
+        self.deadline = deadline
+        self.policy = policy
+        self.cache = cache
+        self.jobs = queue.Queue()
+        self.workers = [threading.Thread(target=self.work, daemon=True) for _ in range(num_workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def work(self):
+        while (job := self.jobs.get()) is not None:
+            future, fn, args = job
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args))
+                except BaseException as exc:
+                    future.set_exception(exc)
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.jobs.put((future, fn, args))
+        return future
+
+    def close(self):
+        for _ in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # ---- Jobs ---- #
+    def call(self, fn, *args):
+        if self.policy is None:
+            return fn(*args)
+        return self.policy.call(fn, *args)
+
+    def cached(self, url):
+        """
+        `url`'s body from the cache, as an open file. The body is only downloaded if it's new or it changed.
+        An open file rather than a path : another worker may evict it any time, that must not break our read.
+        """
+        known = self.cache.lookup(url)
+        headers = {}
+        if known is not None:
+            file, headers = known
+            if file is not None:
+                return file
+        with self.pool.urlopen(url, headers) as response:
+            if response.status == 304 and known is not None:
+                response.read()
+                file = self.cache.revalidated(url)
+                if file is not None:
+                    return file
+            elif response.status != 200:
+                response.read()
+                raise HTTPStatusError(url, response.status, response.reason)
+            else:
+                return self.cache.store(url, response, self.chunk_size)
+        # Not Modified, but it was evicted while we were asking. Fetch the body.
+        with self.pool.urlopen(url) as response:
+            if response.status != 200:
+                response.read()
+                raise HTTPStatusError(url, response.status, response.reason)
+            return self.cache.store(url, response, self.chunk_size)
+
+    def get_json(self, url):
+        if self.cache is not None:
+            with self.cached(url) as file:
+                return json.load(file)
+        with self.pool.urlopen(url) as response:
+            if response.status != 200:
+                response.read()
+                raise HTTPStatusError(url, response.status, response.reason)
+            return json.loads(response.read())
+
+    def save(self, url, path):
+        """
+        Stream `url` into `path`. Returns the number of bytes written.
+        Goes to a temporary file first, renamed to `path` once complete. So a failed (or a losing hedged)
+        attempt never leaves half an image behind.
+        """
+        if self.cache is not None:
+            return self.copy(self.cached(url), path)
+        buffer = bytearray(self.chunk_size)
+        view = memoryview(buffer)
+        written = 0
+        deadline = None if self.deadline is None else time.monotonic() + self.deadline
+        with self.pool.urlopen(url) as response:
+            if response.status != 200:
+                response.read()
+                raise HTTPStatusError(url, response.status, response.reason)
+            fd, part = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.part-')
+            os.close(fd)  # reopened by the sink, possibly with O_DIRECT
+            try:
+                with BufferedSink(part, **self.sink_options) as sink:
+                    while n := response.readinto(view):
+                        sink.write(view[:n])
+                        written += n
+                        if deadline is not None and time.monotonic() > deadline:
+                            raise TimeoutError(f'{url} : not done after {self.deadline}s')
+                os.replace(part, path)
+            except BaseException:
+                os.unlink(part)
+                raise
+        return written
+
+    def copy(self, cached, path):
+        # `cached` : open file from the cache. A hard link costs no copy, but then editing the image would edit the cache too
+        file = tempfile.NamedTemporaryFile(dir=os.path.dirname(path) or '.', prefix='.part-', delete=False)
+        try:
+            with file, cached:
+                shutil.copyfileobj(cached, file, self.chunk_size)
+            os.replace(file.name, path)
+        except BaseException:
+            os.unlink(file.name)
+            raise
+        return os.path.getsize(path)
+
+    def download_photo(self, iden, base_url='https://jsonplaceholder.typicode.com', directory='.'):
+        """Same as `download` + `save_image` in thread_safe_queue.py."""
+        photo = self.call(self.get_json, f'{base_url}/photos/{iden}')
+        return self.call(self.save, photo['thumbnailUrl'], os.path.join(directory, f'pic{iden}.jpg'))
+
+
+# ---- Connection per request vs pooled ---- #
+NUM_PHOTOS = 500
+
+if __name__ == '__main__':
+    with LocalServer(image_size=16 * 1024) as server, tempfile.TemporaryDirectory() as directory:
+        for name, keepalive in ('connection per request', 0), ('pooled keep-alive', 4):
+            before = server.connections
+            start = time.perf_counter()
+            with Downloader(num_workers=8, max_per_host=8, keepalive=keepalive) as downloader:
+                futures = [downloader.submit(downloader.download_photo, i, server.url, directory) for i in range(1, NUM_PHOTOS + 1)]
+                total = sum(future.result() for future in futures)
+            elapsed = time.perf_counter() - start
+            print(f'{name:<24} {elapsed:.4f}s  {total / 2**20:.1f} MiB  {server.connections - before} connections')
@@ -155,9 +155,9 @@ class Queue(Queue):
                 elif timeout < 0:
                     raise ValueError("'timeout' must be a non-negative number")
                 else:
-                    endtime = time() + timeout
+                    endtime = time.monotonic() + timeout
                     while self._qsize() >= self.maxsize:
-                        remaining = endtime - time()
+                        remaining = endtime - time.monotonic()
                         if remaining <= 0.0:
                             raise Full
                         self.not_full.wait(remaining)
@@ -177,9 +177,9 @@ class Queue(Queue):
             elif timeout < 0:
                 raise ValueError("'timeout' must be a non-negative number")
             else:
-                endtime = time() + timeout
+                endtime = time.monotonic() + timeout
                 while not self._qsize():
-                    remaining = endtime - time()
+                    remaining = endtime - time.monotonic()
                     if remaining <= 0.0:
                         raise Empty
                     self.not_empty.wait(remaining)
@@ -188,6 +188,67 @@ class Queue(Queue):
             self.not_full.notify()
             return item
 
+    def put_many(self, items, block=True, timeout=None):
+        """
+        Put a whole batch. Same as calling put for each item, but the lock is taken once
+        (plus once more every time we had to wait for room), and consumers are woken with a single
+        notify(n) instead of one notify() per item. 
+        If the queue doesn't have room for the whole batch, we put what fits, wake consumers, and wait for more room.
+        NOTE : if Full is raised, the items before it are already in the queue.
+        """
+        items = list(items)
+        if timeout is not None and timeout < 0:
+            raise ValueError("'timeout' must be a non-negative number")
+        endtime = None if timeout is None else time.monotonic() + timeout
+        start = 0
+        with self.not_full:
+            while start < len(items):
+                room = len(items) - start
+                if self.maxsize > 0:
+                    room = min(room, self.maxsize - self._qsize())
+                    while room <= 0:
+                        if not block:
+                            raise Full
+                        if endtime is None:
+                            self.not_full.wait()
+                        else:
+                            remaining = endtime - time.monotonic()
+                            if remaining <= 0.0:
+                                raise Full
+                            self.not_full.wait(remaining)
+                        room = min(len(items) - start, self.maxsize - self._qsize())
+                for item in items[start:start + room]:
+                    self._put(item)
+                start += room
+                self.unfinished_tasks += room
+                self.not_empty.notify(room)
+
+    def get_many(self, max_n, block=True, timeout=None):
+        """
+        Wait until there is at least one item (like get), then take up to `max_n` items in one go.
+        Returns a list. Producers waiting for room are woken with a single notify(n).
+        """
+        with self.not_empty:
+            if not block:
+                if not self._qsize():
+                    raise Empty
+            elif timeout is None:
+                while not self._qsize():
+                    self.not_empty.wait()
+            elif timeout < 0:
+                raise ValueError("'timeout' must be a non-negative number")
+            else:
+                endtime = time.monotonic() + timeout
+                while not self._qsize():
+                    remaining = endtime - time.monotonic()
+                    if remaining <= 0.0:
+                        raise Empty
+                    self.not_empty.wait(remaining)
+            n = min(max_n, self._qsize())
+            items = [self._get() for _ in range(n)]
+            self.not_full.notify(n)
+            return items
+
 class Pipeline:
     """
     Class to allow a single element pipeline between producer and consumer.
@@ -203,6 +264,84 @@ class Pipeline:
         self.message_queue.put(message)
 
 
+"""
+# --------- SOLUTION USING a lock-free ring buffer (one producer, one consumer)  ---------- #
+With the lock based Pipeline, producer and consumer strictly take turns, and every message 
+costs two lock operations. With exactly one producer and one consumer we don't need a lock at all :
+
+- A fixed size buffer, allocated once, and two counters. `tail` : how many messages were written,
+  `head` : how many were read. Slot for message i is `i % capacity`.
+- Only the producer ever writes `tail`, only the consumer ever writes `head`. Producer fills the slot 
+  *before* moving tail forward, so the consumer never sees a slot that isn't filled yet.
+  (Each of these assignments is atomic under the GIL.)
+- As long as the buffer is neither empty nor full, nobody waits and nobody takes a lock.
+  Only then the producer (full) or the consumer (empty) blocks on an Event, and the other side sets it.
+
+NOTE : The buffer is a plain list, not an `array` : messages are arbitrary python objects (SENTINEL for one).
+NOTE : With more than one producer or consumer this is broken. Use the Queue based Pipeline for that.
+"""
+
+class RingBufferPipeline:
+    """
+    Drop in replacement for Pipeline, for a single producer and a single consumer.
+    """
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.buffer = [None] * capacity
+        self.head = 0 # written by the consumer only
+        self.tail = 0 # written by the producer only
+        self.not_empty = threading.Event()
+        self.consumer_waiting = False
+        self.not_full = threading.Event()
+        self.producer_waiting = False
+
+    def set_message(self, message, name):
+        tail = self.tail
+        if tail - self.head == self.capacity:
+            logging.debug("%s:buffer full, waiting", name)
+            self.not_full.clear()
+            self.producer_waiting = True
+            # Check again. Consumer might have made room before it could see producer_waiting
+            while tail - self.head == self.capacity:
+                self.not_full.wait()
+                self.not_full.clear()
+            self.producer_waiting = False
+        self.buffer[tail % self.capacity] = message
+        self.tail = tail + 1
+        if self.consumer_waiting:
+            self.not_empty.set()
+
+    def get_message(self, name):
+        head = self.head
+        if self.tail == head:
+            logging.debug("%s:buffer empty, waiting", name)
+            self.not_empty.clear()
+            self.consumer_waiting = True
+            # Check again. Producer might have written before it could see consumer_waiting
+            while self.tail == head:
+                self.not_empty.wait()
+                self.not_empty.clear()
+            self.consumer_waiting = False
+        slot = head % self.capacity
+        message = self.buffer[slot]
+        self.buffer[slot] = None # don't keep the message alive
+        self.head = head + 1
+        if self.producer_waiting:
+            self.not_full.set()
+        return message
+
+
+# if __name__ == "__main__":
+#     format = "%(asctime)s: %(message)s"
+#     logging.basicConfig(format=format, level=logging.INFO,
+#                         datefmt="%H:%M:%S")
+
+#     pipeline = RingBufferPipeline(capacity=16)
+#     with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+#         executor.submit(producer, pipeline)
+#         executor.submit(consumer, pipeline)
+
+
 if __name__ == "__main__":
     format = "%(asctime)s: %(message)s"
     logging.basicConfig(format=format, level=logging.INFO,
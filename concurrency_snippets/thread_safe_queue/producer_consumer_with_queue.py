@@ -5,31 +5,129 @@ import random
 import threading
 import time
 
+
+class Closed(Exception):
+    """put on a closed queue, or get on a closed queue that has been drained."""
+
+
+class ClosableQueue(queue.Queue):
+    """
+    Why : the consumer used to loop on `not event.is_set() or not queue.empty()`. If the queue becomes empty
+    right after that check, `queue.get()` blocks forever because nobody will ever put again.
+
+    With close() the queue itself knows no more items are coming :
+    - put raises Closed from then on (a producer blocked on a full queue gets it too).
+    - get keeps returning what's left, and raises Closed once the queue is empty. 
+      So consumers drain everything, then exit. Nobody waits for an item that never comes.
+    - join(timeout) waits until every item was marked `task_done`, and returns how many are still in flight.
+    """
+    def __init__(self, maxsize=0):
+        super().__init__(maxsize)
+        self.closed = False
+
+    def close(self):
+        with self.mutex:
+            self.closed = True
+            # Wake everybody up. They check `closed` again.
+            self.not_empty.notify_all()
+            self.not_full.notify_all()
+
+    def put(self, item, block=True, timeout=None):
+        with self.not_full:
+            if self.maxsize > 0:
+                if not block:
+                    if self._qsize() >= self.maxsize and not self.closed:
+                        raise queue.Full
+                elif timeout is None:
+                    while self._qsize() >= self.maxsize and not self.closed:
+                        self.not_full.wait()
+                elif timeout < 0:
+                    raise ValueError("'timeout' must be a non-negative number")
+                else:
+                    endtime = time.monotonic() + timeout
+                    while self._qsize() >= self.maxsize and not self.closed:
+                        remaining = endtime - time.monotonic()
+                        if remaining <= 0.0:
+                            raise queue.Full
+                        self.not_full.wait(remaining)
+            if self.closed:
+                raise Closed
+            self._put(item)
+            self.unfinished_tasks += 1
+            self.not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        with self.not_empty:
+            if not block:
+                if not self._qsize():
+                    raise Closed if self.closed else queue.Empty
+            elif timeout is None:
+                while not self._qsize():
+                    if self.closed:
+                        raise Closed
+                    self.not_empty.wait()
+            elif timeout < 0:
+                raise ValueError("'timeout' must be a non-negative number")
+            else:
+                endtime = time.monotonic() + timeout
+                while not self._qsize():
+                    if self.closed:
+                        raise Closed
+                    remaining = endtime - time.monotonic()
+                    if remaining <= 0.0:
+                        raise queue.Empty
+                    self.not_empty.wait(remaining)
+            item = self._get()
+            self.not_full.notify()
+            return item
+
+    def join(self, timeout=None):
+        with self.all_tasks_done:
+            if timeout is None:
+                while self.unfinished_tasks:
+                    self.all_tasks_done.wait()
+            else:
+                endtime = time.monotonic() + timeout
+                while self.unfinished_tasks:
+                    remaining = endtime - time.monotonic()
+                    if remaining <= 0.0:
+                        break
+                    self.all_tasks_done.wait(remaining)
+            return self.unfinished_tasks
+
+
 def producer(queue, event):
     """Pretend we're getting a number from the network."""
     while not event.is_set():
         message = random.randint(1, 101)
         logging.info("Producer got message: %s", message)
-        queue.put(message)
+        try:
+            queue.put(message)
+        except Closed:
+            break
 
     logging.info("Producer received event. Exiting")
 
-def consumer(queue, event):
+def consumer(queue):
     """Pretend we're saving a number in the database."""
-    while not event.is_set() or not queue.empty():
-        message = queue.get()
+    while True:
+        try:
+            message = queue.get()
+        except Closed:
+            break
         logging.info(
             "Consumer storing message: %s (size=%d)", message, queue.qsize()
         )
+        queue.task_done()
 
-    logging.info("Consumer received event. Exiting")
+    logging.info("Queue closed and drained. Consumer exiting")
 
 if __name__ == "__main__":
     format = "%(asctime)s: %(message)s"
     logging.basicConfig(format=format, level=logging.INFO,
                         datefmt="%H:%M:%S")
 
-    pipeline = queue.Queue(maxsize=10)
+    pipeline = ClosableQueue(maxsize=10)
 
     # NOTE : doing something like : event = True
     # And setting event to False after 0.1 seconds doesn't work. 
@@ -37,8 +135,12 @@ if __name__ == "__main__":
     event = threading.Event()
     with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
         executor.submit(producer, pipeline, event)
-        executor.submit(consumer, pipeline, event)
+        executor.submit(consumer, pipeline)
 
         time.sleep(0.1)
         logging.info("Main: about to set event")
         event.set()
+        # No more puts from here. Consumer drains what's left, then exits.
+        pipeline.close()
+        in_flight = pipeline.join(timeout=5)
+        logging.info("Main: queue drained, %d message(s) still in flight", in_flight)
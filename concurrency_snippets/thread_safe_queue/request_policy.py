@@ -0,0 +1,164 @@
+"""
+Gist :
+The workers in `thread_safe_queue.py` call `requests.get` with no timeout. One endpoint that never answers
+pins a worker forever, `task_done` is never called and `q.join()` never returns.
+Timeouts fix the "forever". What's left is the tail : a fan-out of 500 downloads is as slow as the slowest one.
+
+RequestPolicy wraps one attempt (a function) with :
+- Retries : on connection errors, timeouts and 5xx / 429. Exponential backoff with full jitter :
+  sleep a random time in [0, min(backoff_max, backoff_base * 2 ** attempt)].
+  Without the jitter, every worker that failed at the same moment retries at the same moment too.
+- Hedged requests : if an attempt isn't done after the p95 latency of it's kind, send the same request again
+  and take whichever answers first. Only ~5% of the requests get a duplicate, but the slow tail they
+  were stuck in is cut down to roughly p95 + a normal request. (The Tail at Scale, Dean & Barroso)
+  NOTE : only for requests that are safe to send twice. A GET into a temporary file is.
+- Latency : every attempt (kind, attempt number, hedged or not, seconds, error) goes to `attempts`.
+  The p95 used for hedging is computed from the successful ones, per kind (the function name).
+
+Connect / read timeouts are set on the connection pool, see `pooled_downloader.py`.
+"""
+import concurrent.futures
+import http.client
+import random
+import tempfile
+import time
+from collections import deque, namedtuple
+
+from local_http_server import LocalServer
+from pooled_downloader import Downloader, HTTPStatusError
+
+Attempt = namedtuple('Attempt', 'kind attempt hedged latency error')
+
+
+def retryable(exc):
+    if isinstance(exc, HTTPStatusError):
+        return exc.status >= 500 or exc.status == 429
+    # Timeouts are OSErrors too
+    return isinstance(exc, (OSError, http.client.HTTPException))
+
+
+class LatencyRecorder:
+    def __init__(self, window=1000):
+        self.window = window
+        self.attempts = deque(maxlen=100_000)
+        self.latencies = {}  # kind -> recent successful latencies
+
+    def record(self, attempt):
+        self.attempts.append(attempt)
+        if attempt.error is None:
+            if attempt.kind not in self.latencies:
+                self.latencies[attempt.kind] = deque(maxlen=self.window)
+            self.latencies[attempt.kind].append(attempt.latency)
+
+    def percentile(self, kind, p, min_samples=20):
+        latencies = self.latencies.get(kind)
+        if latencies is None or len(latencies) < min_samples:
+            return None
+        ordered = sorted(latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+
+class RequestPolicy:
+    def __init__(self, retries=3, backoff_base=0.1, backoff_max=5.0, hedge=False, hedge_percentile=95,
+                 hedge_delay=1.0, hedge_workers=16):
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        # Used until there are enough samples for a percentile
+        self.hedge_delay = hedge_delay
+        self.recorder = LatencyRecorder()
+        self.executor = concurrent.futures.ThreadPoolExecutor(hedge_workers) if hedge else None
+
+    @property
+    def attempts(self):
+        return self.recorder.attempts
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def call(self, fn, *args):
+        for attempt in range(self.retries + 1):
+            try:
+                if self.hedge:
+                    return self.hedged(fn, args, attempt)
+                return self.timed(fn, args, attempt, False)
+            except Exception as exc:
+                if attempt == self.retries or not retryable(exc):
+                    raise
+            time.sleep(self.backoff(attempt))
+
+    def timed(self, fn, args, attempt, hedged, start=None):
+        # `start` : when the attempt was handed to the executor. The wait for an executor thread is
+        # part of what the caller sees, so it counts in the latency used for the hedge delay too.
+        start = start or time.perf_counter()
+        error = None
+        try:
+            return fn(*args)
+        except Exception as exc:
+            error = exc
+            raise
+        finally:
+            self.recorder.record(Attempt(fn.__name__, attempt, hedged, time.perf_counter() - start, error))
+
+    def hedged(self, fn, args, attempt):
+        delay = self.recorder.percentile(fn.__name__, self.hedge_percentile) or self.hedge_delay
+        first = self.executor.submit(self.timed, fn, args, attempt, False, time.perf_counter())
+        try:
+            return first.result(timeout=delay)
+        except concurrent.futures.TimeoutError:
+            pass
+        second = self.executor.submit(self.timed, fn, args, attempt, True, time.perf_counter())
+        # First one to succeed wins. The loser can't be interrupted, it runs until it's own timeout.
+        error = None
+        for future in concurrent.futures.as_completed((first, second)):
+            if future.exception() is None:
+                return future.result()
+            error = future.exception()
+        raise error
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+
+    def print_summary(self):
+        for kind in sorted({attempt.kind for attempt in self.attempts}):
+            attempts = [attempt for attempt in self.attempts if attempt.kind == kind]
+            latencies = sorted(attempt.latency for attempt in attempts if attempt.error is None)
+            failed = sum(attempt.error is not None for attempt in attempts)
+            hedged = sum(attempt.hedged for attempt in attempts)
+            retried = sum(attempt.attempt > 0 for attempt in attempts)
+            p50 = latencies[len(latencies) // 2] * 1000 if latencies else 0
+            p99 = latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0
+            print(f'  {kind:<10} attempts {len(attempts):>5}  failed {failed:>4}  retried {retried:>4}  '
+                  f'hedged {hedged:>4}  p50 {p50:7.2f}ms  p99 {p99:7.2f}ms')
+
+
+# ---- Slow tail, with and without hedging ---- #
+NUM_PHOTOS = 500
+
+def timed_downloads(downloader, base_url, directory):
+    # End to end latency of each photo (lookup + image)
+    def one(iden):
+        start = time.perf_counter()
+        downloader.download_photo(iden, base_url, directory)
+        return time.perf_counter() - start
+    futures = [downloader.submit(one, i) for i in range(1, NUM_PHOTOS + 1)]
+    return sorted(future.result() for future in futures)
+
+if __name__ == '__main__':
+    # 2% of the requests take 300ms, the rest are instant
+    with LocalServer(image_size=16 * 1024, tail_delay=0.3, tail_fraction=0.02) as server, \
+            tempfile.TemporaryDirectory() as directory:
+        for name, policy in ('no policy', None), ('retries + hedging', RequestPolicy(hedge=True, hedge_delay=0.05)):
+            start = time.perf_counter()
+            with Downloader(num_workers=16, max_per_host=64, keepalive=32, timeout=(1.0, 2.0), policy=policy) as downloader:
+                latencies = timed_downloads(downloader, server.url, directory)
+            elapsed = time.perf_counter() - start
+            p50 = latencies[len(latencies) // 2] * 1000
+            p99 = latencies[int(len(latencies) * 0.99)] * 1000
+            print(f'{name:<18} {elapsed:.4f}s  photo p50 {p50:.2f}ms  p99 {p99:.2f}ms')
+            if policy is not None:
+                policy.close()
+                policy.print_summary()
@@ -0,0 +1,213 @@
+"""
+Gist :
+In `producer_consumer.py`'s main, 3 producers and 2 consumers share ONE queue. Every put and get, from
+every thread, goes through the same lock (the queue's Condition). Add more consumers and they mostly wait
+for that lock, throughput flattens.
+
+Sharding : N queues (shards) instead of one, each with it's own lock and it's own consumer thread.
+A message goes to shard `hash(key) % N`, so threads only contend when they touch the same shard.
+The key (a user id, a log source ..) also gives us ordering : all messages of a key land in the same shard,
+and are handled in the order they were sent.
+
+Stealing : with skewed keys, one shard can pile up while another consumer sits idle. An idle consumer
+takes work from the front of the busiest shard. To keep per key ordering :
+- Whoever takes a batch (owner or thief) marks it's keys `busy` until it's done handling them.
+- Batches are only taken from the front, and taking stops at the first key somebody else has busy.
+So two messages of the same key are never handled at the same time, or out of order.
+
+NOTE : With a handler this cheap, the GIL is the real bottleneck and both setups come out about the same.
+The gap shows up once handlers release the GIL (I/O, C extensions) and more consumers fight over one lock.
+"""
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+
+class Shard:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = deque()  # (key, message)
+        self.busy = set()     # keys being handled right now
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.not_full = threading.Condition(self.mutex)
+
+    def takeable(self):
+        return self.items and self.items[0][0] not in self.busy
+
+
+class ShardedPipeline:
+    """
+    `handler(message)` is called for every message, from the consumer threads.
+    `key(message)` picks the shard. By default the message itself is the key.
+    """
+    def __init__(self, handler, num_shards=4, key=None, maxsize=0, batch_size=64, steal=True, steal_interval=0.01):
+        self.handler = handler
+        self.key = key or (lambda message: message)
+        self.shards = [Shard(maxsize) for _ in range(num_shards)]
+        self.batch_size = batch_size
+        self.steal = steal
+        self.steal_interval = steal_interval
+        self.closed = False
+        self.threads = []
+
+    def start(self):
+        for index in range(len(self.shards)):
+            thread = threading.Thread(target=self.consume, args=(index,), name=f'shard-{index}')
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def set_message(self, message, name):
+        key = self.key(message)
+        shard = self.shards[hash(key) % len(self.shards)]
+        with shard.not_full:
+            while shard.maxsize and len(shard.items) >= shard.maxsize and not self.closed:
+                shard.not_full.wait()
+            if self.closed:
+                raise RuntimeError('set_message on a closed pipeline')
+            shard.items.append((key, message))
+            shard.not_empty.notify()
+
+    def close(self):
+        """No more messages. Consumers handle whatever is left, then exit."""
+        self.closed = True
+        for shard in self.shards:
+            with shard.mutex:
+                shard.not_empty.notify_all()
+                shard.not_full.notify_all()
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    # ---- Consumer side ---- #
+    def consume(self, index):
+        shard = self.shards[index]
+        while True:
+            batch = self.take(shard, self.steal_interval if self.steal else None)
+            if batch is None:
+                return
+            if batch:
+                self.handle(shard, batch)
+            elif self.steal:
+                self.steal_from_peer(index)
+
+    def take(self, shard, timeout=None, block=True):
+        """
+        Returns a batch of (key, message) from the front of the shard.
+        [] if there was nothing to take in time, None once the pipeline is closed and the shard is drained.
+        """
+        with shard.not_empty:
+            if timeout is not None:
+                endtime = time.monotonic() + timeout
+            while not shard.takeable():
+                if self.closed and not shard.items:
+                    return None
+                if not block:
+                    return []
+                if timeout is None:
+                    shard.not_empty.wait()
+                else:
+                    remaining = endtime - time.monotonic()
+                    if remaining <= 0.0:
+                        return []
+                    shard.not_empty.wait(remaining)
+            batch = []
+            keys = set()
+            items = shard.items
+            while items and len(batch) < self.batch_size and items[0][0] not in shard.busy:
+                key, message = items.popleft()
+                batch.append((key, message))
+                keys.add(key)
+            shard.busy |= keys
+            shard.not_full.notify(len(batch))
+            return batch
+
+    def handle(self, shard, batch):
+        try:
+            for _, message in batch:
+                self.handler(message)
+        finally:
+            with shard.mutex:
+                shard.busy.difference_update(key for key, _ in batch)
+                # Someone may be waiting because the key at the front was busy
+                shard.not_empty.notify_all()
+
+    def steal_from_peer(self, index):
+        victim = max(
+            (shard for i, shard in enumerate(self.shards) if i != index),
+            key=lambda shard: len(shard.items),
+            default=None,
+        )
+        if victim is None or not victim.items:
+            return
+        batch = self.take(victim, block=False)
+        if batch:
+            self.handle(victim, batch)
+
+
+# ---- Single shared queue vs sharded ---- #
+NUM_PRODUCERS = 3
+NUM_CONSUMERS = 4
+NUM_MESSAGES = 50_000 # per producer
+NUM_KEYS = 1_000
+
+SENTINEL = object()
+
+def handle_message(message):
+    # Pretend we're saving to the database
+    user, seq = message
+    return user * seq
+
+def produce(pipeline, offset):
+    for seq in range(NUM_MESSAGES):
+        pipeline.set_message(((seq + offset) % NUM_KEYS, seq), "Producer")
+
+class SharedQueuePipeline:
+    """The old setup : one queue, every consumer pulls from it."""
+    def __init__(self, handler, num_consumers):
+        self.queue = queue.Queue(maxsize=1000)
+        self.threads = [threading.Thread(target=self.consume, args=(handler,)) for _ in range(num_consumers)]
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+    def consume(self, handler):
+        while (message := self.queue.get()) is not SENTINEL:
+            handler(message)
+    def set_message(self, message, name):
+        self.queue.put(message)
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(SENTINEL)
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+def timed(pipeline):
+    start = time.perf_counter()
+    pipeline.start()
+    producers = [threading.Thread(target=produce, args=(pipeline, i)) for i in range(NUM_PRODUCERS)]
+    for thread in producers:
+        thread.start()
+    for thread in producers:
+        thread.join()
+    pipeline.close()
+    pipeline.join()
+    return time.perf_counter() - start
+
+if __name__ == "__main__":
+    format = "%(asctime)s: %(message)s"
+    logging.basicConfig(format=format, level=logging.INFO,
+                        datefmt="%H:%M:%S")
+
+    total = NUM_PRODUCERS * NUM_MESSAGES
+    for name, pipeline in [
+        ('single shared queue', SharedQueuePipeline(handle_message, NUM_CONSUMERS)),
+        ('sharded', ShardedPipeline(handle_message, NUM_CONSUMERS, key=lambda message: message[0], maxsize=1000)),
+    ]:
+        elapsed = timed(pipeline)
+        logging.info("%-20s %.4fs  %s messages/sec", name, elapsed, f'{total / elapsed:,.0f}')
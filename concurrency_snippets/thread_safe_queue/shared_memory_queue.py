@@ -0,0 +1,179 @@
+"""
+Gist :
+Same producer / consumer Pipeline as in `producer_consumer.py`, but across processes.
+With threads, a CPU heavy consumer (parsing before saving to the database) is stuck behind the GIL.
+With processes each consumer gets it's own core, but now messages have to travel between processes.
+
+`multiprocessing.Queue` pickles every message, writes it to a pipe, and a feeder thread + the kernel copy it
+again on the way. For big messages that's most of the cost. Here, messages go through a ring buffer in
+shared memory instead (`multiprocessing.shared_memory`) : the producer copies the bytes in, the consumer copies them out.
+
+Layout of the shared memory block :
+    [ head : 8 bytes ][ tail : 8 bytes ][ ring buffer : capacity bytes ]
+- head / tail count bytes read / written so far. Position in the ring is `count % capacity`.
+- Each message is a record : [ length : 4 bytes ][ kind : 1 byte ][ payload ]. A record can wrap around the end.
+- kind RAW : payload is the message itself (bytes, bytearray, memoryview). No pickling.
+  kind PICKLED : anything else gets pickled, so the Pipeline API stays the same for ints e.t.c.
+  kind SENTINEL : no payload. Comes out as `SENTINEL` on the other side. (the object itself can't cross
+  processes, it's identity would be lost.)
+
+Waking up :
+- `items` is a semaphore counting records in the ring. Consumers block on it when it's empty.
+- `not_full` is a condition. Producers wait on it when there's no room, consumers notify after making room.
+- `lock` (the condition's lock) protects head / tail. The copy happens under it too, so
+  any number of producers and consumers can share the pipeline.
+"""
+import logging
+import multiprocessing as mp
+import pickle
+import struct
+import time
+from multiprocessing import shared_memory
+
+from producer_consumer import SENTINEL, producer, consumer
+
+RAW, PICKLED, END = 0, 1, 2
+
+HEADER = struct.Struct('QQ')   # head, tail
+RECORD = struct.Struct('IB')   # length, kind
+
+class SharedMemoryPipeline:
+    """
+    Bounded multi-process pipeline. `capacity` is in bytes.
+    Create it in the parent and hand it to `multiprocessing.Process` as an argument.
+    The parent calls `unlink` once everybody is done.
+    """
+    def __init__(self, capacity=1 << 20):
+        self.capacity = capacity
+        self.shm = shared_memory.SharedMemory(create=True, size=HEADER.size + capacity)
+        self.buf = self.shm.buf
+        HEADER.pack_into(self.buf, 0, 0, 0)
+        self.lock = mp.Lock()
+        self.not_full = mp.Condition(self.lock)
+        self.items = mp.Semaphore(0)
+
+    # memoryviews can't be pickled. Re-create it on the other side.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['buf']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.buf = self.shm.buf
+
+    def _write(self, pos, data):
+        start = HEADER.size + pos % self.capacity
+        first = min(len(data), HEADER.size + self.capacity - start)
+        self.buf[start:start + first] = data[:first]
+        if first < len(data):
+            self.buf[HEADER.size:HEADER.size + len(data) - first] = data[first:]
+
+    def _read(self, pos, size):
+        start = HEADER.size + pos % self.capacity
+        first = min(size, HEADER.size + self.capacity - start)
+        if first == size:
+            return bytes(self.buf[start:start + size])
+        return bytes(self.buf[start:start + first]) + bytes(self.buf[HEADER.size:HEADER.size + size - first])
+
+    def set_message(self, message, name):
+        if message is SENTINEL:
+            kind, payload = END, b''
+        elif isinstance(message, (bytes, bytearray, memoryview)):
+            kind, payload = RAW, memoryview(message).cast('B')
+        else:
+            kind, payload = PICKLED, pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        size = RECORD.size + len(payload)
+        if size > self.capacity:
+            raise ValueError(f'Message of {len(payload)} bytes does not fit in a {self.capacity} bytes pipeline')
+
+        with self.not_full:
+            head, tail = HEADER.unpack_from(self.buf, 0)
+            while self.capacity - (tail - head) < size:
+                logging.debug("%s:pipeline full, waiting", name)
+                self.not_full.wait()
+                head, tail = HEADER.unpack_from(self.buf, 0)
+            self._write(tail, RECORD.pack(len(payload), kind))
+            self._write(tail + RECORD.size, payload)
+            HEADER.pack_into(self.buf, 0, head, tail + size)
+        self.items.release()
+
+    def get_message(self, name):
+        self.items.acquire()
+        with self.not_full:
+            head, tail = HEADER.unpack_from(self.buf, 0)
+            length, kind = RECORD.unpack(self._read(head, RECORD.size))
+            payload = self._read(head + RECORD.size, length)
+            HEADER.pack_into(self.buf, 0, head + RECORD.size + length, tail)
+            self.not_full.notify_all()
+        if kind == RAW:
+            return payload
+        if kind == PICKLED:
+            return pickle.loads(payload)
+        return SENTINEL
+
+    def close(self):
+        self.buf.release()
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+# ---- Throughput comparison with multiprocessing.Queue ---- #
+MESSAGE_SIZE = 64 * 1024
+NUM_MESSAGES = 5_000
+
+def bulk_producer(pipeline):
+    message = b'x' * MESSAGE_SIZE
+    for _ in range(NUM_MESSAGES):
+        pipeline.set_message(message, "Producer")
+    pipeline.set_message(SENTINEL, "Producer")
+
+def bulk_consumer(pipeline):
+    while pipeline.get_message("Consumer") is not SENTINEL:
+        pass
+
+class QueuePipeline:
+    """multiprocessing.Queue behind the same API, for comparison."""
+    def __init__(self, size):
+        self.queue = mp.Queue(size)
+    def set_message(self, message, name):
+        self.queue.put(None if message is SENTINEL else message)
+    def get_message(self, name):
+        message = self.queue.get()
+        return SENTINEL if message is None else message
+
+def timed(pipeline):
+    processes = [mp.Process(target=bulk_producer, args=(pipeline,)), mp.Process(target=bulk_consumer, args=(pipeline,))]
+    start = time.perf_counter()
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    format = "%(asctime)s: %(message)s"
+    logging.basicConfig(format=format, level=logging.INFO,
+                        datefmt="%H:%M:%S")
+
+    # Same producer / consumer functions as the threaded version. Each in it's own process.
+    pipeline = SharedMemoryPipeline(capacity=1024)
+    processes = [mp.Process(target=producer, args=(pipeline,)) for _ in range(2)]
+    processes += [mp.Process(target=consumer, args=(pipeline,)) for _ in range(2)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    pipeline.close()
+    pipeline.unlink()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    shm_pipeline = SharedMemoryPipeline(capacity=16 * MESSAGE_SIZE)
+    for name, pipeline in ('multiprocessing.Queue', QueuePipeline(16)), ('SharedMemoryPipeline', shm_pipeline):
+        elapsed = timed(pipeline)
+        print(f'{name:<22} {elapsed:.4f}s  {NUM_MESSAGES * MESSAGE_SIZE / elapsed / 2**20:,.0f} MiB/sec')
+    shm_pipeline.close()
+    shm_pipeline.unlink()
@@ -1,5 +1,5 @@
 import queue
-from queue import Full
+from queue import Full, Empty
 import threading
 import time
 import requests
@@ -41,9 +41,9 @@ class Queue(queue.Queue):
                 elif timeout < 0:
                     raise ValueError("'timeout' must be a non-negative number")
                 else:
-                    endtime = time() + timeout
+                    endtime = time.monotonic() + timeout
                     while self._qsize() >= self.maxsize:
-                        remaining = endtime - time()
+                        remaining = endtime - time.monotonic()
                         if remaining <= 0.0:
                             raise Full
                         self.not_full.wait(remaining)
@@ -62,9 +62,9 @@ class Queue(queue.Queue):
             elif timeout < 0:
                 raise ValueError("'timeout' must be a non-negative number")
             else:
-                endtime = time() + timeout
+                endtime = time.monotonic() + timeout
                 while not self._qsize():
-                    remaining = endtime - time()
+                    remaining = endtime - time.monotonic()
                     if remaining <= 0.0:
                         raise Empty
                     self.not_empty.wait(remaining)
@@ -73,9 +73,74 @@ class Queue(queue.Queue):
             self.not_full.notify()
             return item
 
+    def put_many(self, items, block=True, timeout=None):
+        """
+        Put a whole batch. Same as calling put for each item, but the lock is taken once
+        (plus once more every time we had to wait for room), and consumers are woken with a single
+        notify(n) instead of one notify() per item. 
+        If the queue doesn't have room for the whole batch, we put what fits, wake consumers, and wait for more room.
+        NOTE : if Full is raised, the items before it are already in the queue.
+        """
+        items = list(items)
+        if timeout is not None and timeout < 0:
+            raise ValueError("'timeout' must be a non-negative number")
+        endtime = None if timeout is None else time.monotonic() + timeout
+        start = 0
+        with self.not_full:
+            while start < len(items):
+                room = len(items) - start
+                if self.maxsize > 0:
+                    room = min(room, self.maxsize - self._qsize())
+                    while room <= 0:
+                        if not block:
+                            raise Full
+                        if endtime is None:
+                            self.not_full.wait()
+                        else:
+                            remaining = endtime - time.monotonic()
+                            if remaining <= 0.0:
+                                raise Full
+                            self.not_full.wait(remaining)
+                        room = min(len(items) - start, self.maxsize - self._qsize())
+                for item in items[start:start + room]:
+                    self._put(item)
+                start += room
+                self.unfinished_tasks += room
+                self.not_empty.notify(room)
+
+    def get_many(self, max_n, block=True, timeout=None):
+        """
+        Wait until there is at least one item (like get), then take up to `max_n` items in one go.
+        Returns a list. Producers waiting for room are woken with a single notify(n).
+        """
+        with self.not_empty:
+            if not block:
+                if not self._qsize():
+                    raise Empty
+            elif timeout is None:
+                while not self._qsize():
+                    self.not_empty.wait()
+            elif timeout < 0:
+                raise ValueError("'timeout' must be a non-negative number")
+            else:
+                endtime = time.monotonic() + timeout
+                while not self._qsize():
+                    remaining = endtime - time.monotonic()
+                    if remaining <= 0.0:
+                        raise Empty
+                    self.not_empty.wait(remaining)
+            n = min(max_n, self._qsize())
+            items = [self._get() for _ in range(n)]
+            self.not_full.notify(n)
+            return items
+
+# (connect, read) seconds. Without it, a server that never answers blocks the worker forever.
+# For retries and hedged requests see `request_policy.py`
+TIMEOUT = (3.05, 10)
+
 def save_image(id, url):
     with open(f'pic{id}.jpg','wb') as image:
-        response = requests.get(url, stream=True)
+        response = requests.get(url, stream=True, timeout=TIMEOUT)
         for block in response.iter_content(1024):
             if not block:
                 break
@@ -86,24 +151,29 @@ def download(queue):
     print('Befoer get')
     iden = queue.get()
     print('After get')
-    result = requests.get(f"https://jsonplaceholder.typicode.com/photos/{iden}")
-    url = result.json()["thumbnailUrl"]
-    # save_image(id, url)
-    print(f"Save image {iden}")
-    queue.task_done() # this is new 
+    try:
+        result = requests.get(f"https://jsonplaceholder.typicode.com/photos/{iden}", timeout=TIMEOUT)
+        url = result.json()["thumbnailUrl"]
+        # save_image(id, url)
+        print(f"Save image {iden}")
+    finally:
+        # Even if the request failed. Otherwise q.join() waits for this item forever.
+        queue.task_done() # this is new 
     
 NUM_THREADS = 10
-q = queue.Queue()
 
-for i in range(NUM_THREADS):
-    worker = threading.Thread(target=download,args=(q,))
-    worker.start()
+if __name__ == '__main__':
+    q = queue.Queue()
+
+    for i in range(NUM_THREADS):
+        worker = threading.Thread(target=download,args=(q,))
+        worker.start()
 
-# for i in range(NUM_THREADS):
-#     id = random.randint(1,100)
-#     q.put(id)
+    # for i in range(NUM_THREADS):
+    #     id = random.randint(1,100)
+    #     q.put(id)
 
-q.join() # this is new
+    q.join() # this is new
 
 
 